@@ -1,11 +1,18 @@
+import warnings
 import torch
 import torch.nn.functional as F
 from gym.spaces import Box, Discrete
 from utils.networks import MLPNetwork
-from utils.misc import soft_update, average_gradients, onehot_from_logits, gumbel_softmax
-from utils.agents import DDPGAgent
+from utils.misc import soft_update, average_gradients, onehot_from_logits, gumbel_softmax, clip_grad_norm_stacked
+from utils.agents import DDPGAgent, StackedDDPGAgent
 
 MSELoss = torch.nn.MSELoss()
+# range where stacked networks beat the per-agent loop (benchmark.py stacked):
+# the batched matrix multiplies stop paying for the padding and the layout
+# copies of the stacked input BatchNorm beyond 8 agents, or when padding to
+# the largest input dimension adds more than a quarter to the inputs
+STACKED_MAX_AGENTS = 8
+STACKED_MAX_PADDING = 1.25
 
 class MADDPG(object):
     """
@@ -13,7 +20,7 @@ class MADDPG(object):
     """
     def __init__(self, agent_init_params, alg_types,
                  gamma=0.95, tau=0.01, lr=0.01, hidden_dim=64,
-                 discrete_action=False):
+                 discrete_action=False, stacked=False):
         """
         Inputs:
             agent_init_params (list of dict): List of dicts with parameters to
@@ -28,13 +35,41 @@ class MADDPG(object):
             lr (float): Learning rate for policy and critic
             hidden_dim (int): Number of hidden dimensions for networks
             discrete_action (bool): Whether or not to use discrete action space
+            stacked (bool): Hold the networks of all agents in one
+                            StackedDDPGAgent (the only entry of self.agents),
+                            which evaluates them for all agents at once.
+                            Only update_all is supported. Pays off for up
+                            to STACKED_MAX_AGENTS agents with similar input
+                            dimensions (warns otherwise)
         """
         self.nagents = len(alg_types)
         self.alg_types = alg_types
-        self.agents = [DDPGAgent(lr=lr, discrete_action=discrete_action,
-                                 hidden_dim=hidden_dim,
-                                 **params)
-                       for params in agent_init_params]
+        self.stacked = stacked
+        if stacked:
+            if any(alg != 'MADDPG' for alg in alg_types):
+                raise ValueError("Stacked networks are only supported for MADDPG")
+            padding = max(
+                len(dims) * max(dims) / sum(dims) for dims in
+                [[params[key] for params in agent_init_params]
+                 for key in ('num_in_pol', 'num_in_critic')])
+            if (self.nagents > STACKED_MAX_AGENTS or
+                    padding > STACKED_MAX_PADDING):
+                warnings.warn(
+                    "Stacked networks are usually slower than per-agent "
+                    "networks beyond %i agents or %.2fx input padding (got "
+                    "%i agents, %.2fx padding)" % (
+                        STACKED_MAX_AGENTS, STACKED_MAX_PADDING,
+                        self.nagents, padding))
+            self.agents = [StackedDDPGAgent(
+                [params['num_in_pol'] for params in agent_init_params],
+                [params['num_out_pol'] for params in agent_init_params],
+                [params['num_in_critic'] for params in agent_init_params],
+                lr=lr, discrete_action=discrete_action, hidden_dim=hidden_dim)]
+        else:
+            self.agents = [DDPGAgent(lr=lr, discrete_action=discrete_action,
+                                     hidden_dim=hidden_dim,
+                                     **params)
+                           for params in agent_init_params]
         self.agent_init_params = agent_init_params
         self.gamma = gamma
         self.tau = tau
@@ -45,6 +80,7 @@ class MADDPG(object):
         self.trgt_pol_dev = 'cpu'  # device for target policies
         self.trgt_critic_dev = 'cpu'  # device for target critics
         self.niter = 0
+        self.scripted = False  # networks replaced by TorchScript (compile)
 
     @property
     def policies(self):
@@ -67,23 +103,63 @@ class MADDPG(object):
         for a in self.agents:
             a.reset_noise()
 
-    def step(self, observations, explore=False, parameter_sharing=False):
+    def step(self, observations, explore=False, parameter_sharing=False,
+             advance_noise=True):
         """
         Take a step forward in environment with all agents
         Inputs:
             observations: List of observations for each agent
             explore (boolean): Whether or not to add exploration noise
+            advance_noise (boolean): Draw the next OU noise samples (False
+                                     reuses the last ones, for envs of the
+                                     same step acted on in several calls)
         Outputs:
             actions: List of actions for each agent
         """     
+        if self.stacked:
+            return self.agents[0].step(
+                observations, explore=explore,
+                nets=[0] * self.nagents if parameter_sharing else None,
+                advance_noise=advance_noise)
         if parameter_sharing==True:
-            return [self.agents[0].step(obs, explore=explore) for obs in observations] 
+            return [self.agents[0].step(obs, explore=explore,
+                                        advance_noise=advance_noise)
+                    for obs in observations]
         else: 
-            return [a.step(obs, explore=explore) for a, obs in zip(self.agents,
-                                                                 observations)]
+            return [a.step(obs, explore=explore, advance_noise=advance_noise)
+                    for a, obs in zip(self.agents, observations)]
+
 
+    def act(self, observations, explore=False, parameter_sharing=False,
+            out=None, advance_noise=True):
+        """
+        Rollout fast path of step, run under torch.inference_mode (no_grad
+        for scripted networks, whose executor can't take inference tensors
+        once it has run them under autograd)
+        Inputs:
+            observations: List of float32 numpy observation blocks, one
+                          (batch, obs_dim) array per agent (used in place
+                          through torch.from_numpy)
+            explore (boolean): Whether or not to add exploration noise
+            out: List of numpy arrays for each agent's actions, reused
+                 across calls (new arrays if None)
+            advance_noise (boolean): As for step
+        Outputs:
+            actions: List of numpy actions for each agent
+        """
+        with torch.no_grad() if self.scripted else torch.inference_mode():
+            torch_actions = self.step([torch.from_numpy(ob) for ob in observations],
+                                      explore=explore,
+                                      parameter_sharing=parameter_sharing,
+                                      advance_noise=advance_noise)
+            if out is None:
+                return [ac.numpy() for ac in torch_actions]
+            for ac_out, ac in zip(out, torch_actions):
+                ac_out[...] = ac.numpy()
+        return out
 
-    def update(self, sample, agent_i, parallel=False, logger=None):
+    def update(self, sample, agent_i, parallel=False, logger=None,
+               weights=None):
         """
         Update parameters of agent model based on sample from replay buffer
         Inputs:
@@ -95,11 +171,54 @@ class MADDPG(object):
             parallel (bool): If true, will average gradients across threads
             logger (SummaryWriter from Tensorboard-Pytorch):
                 If passed in, important quantities will be logged
+            weights (torch.Tensor): Importance-sampling weights of the
+                                    sampled transitions in the critic loss
+                                    (prioritized replay)
+        Outputs:
+            td_errors (torch.Tensor): Critic TD errors of the transitions
         """
-        obs, acs, rews, next_obs, dones = sample
+        if self.stacked:
+            raise ValueError("Stacked networks are updated for all agents "
+                             "at once, with update_all")
         curr_agent = self.agents[agent_i]
 
         curr_agent.critic_optimizer.zero_grad()
+        vf_loss, td_errors = self._critic_loss(sample, agent_i,
+                                               weights=weights)
+        vf_loss.backward()
+        self._step_nets('critic', [curr_agent], parallel)
+
+        curr_agent.policy_optimizer.zero_grad()
+        pol_loss = self._policy_loss(sample[0], agent_i)
+        pol_loss.backward()
+        self._step_nets('policy', [curr_agent], parallel)
+        if logger is not None:
+            logger.add_scalars('agent%i/losses' % agent_i,
+                               {'vf_loss': vf_loss,
+                                'pol_loss': pol_loss},
+                               self.niter)
+        return td_errors
+
+    def _step_nets(self, name, agents, parallel=False):
+        # clip the gradients of the agents' networks called name ('critic'
+        # or 'policy') and step their optimizers
+        for agent in agents:
+            net = getattr(agent, name)
+            if parallel:
+                average_gradients(net)
+            if self.stacked:
+                clip_grad_norm_stacked(net.parameters(), 0.5, self.nagents)
+            else:
+                torch.nn.utils.clip_grad_norm_(net.parameters(), 0.5)
+            getattr(agent, name + '_optimizer').step()
+
+    # The loss functions below only compute (no optimizer steps, logging or
+    # counters), so that compile can wrap them
+
+    def _critic_loss(self, sample, agent_i, weights=None):
+        # critic loss of agent_i and its TD errors
+        obs, acs, rews, next_obs, dones = sample
+        curr_agent = self.agents[agent_i]
         if self.alg_types[agent_i] == 'MADDPG':
             if self.discrete_action: # one-hot encode action
                 all_trgt_acs = [onehot_from_logits(pi(nobs)) for pi, nobs in
@@ -128,15 +247,16 @@ class MADDPG(object):
         # else:  # DDPG
         #     vf_in = torch.cat((obs[agent_i], acs[agent_i]), dim=1)
         actual_value = curr_agent.critic(vf_in)
-        vf_loss = MSELoss(actual_value, target_value.detach())
-        vf_loss.backward()
-        if parallel:
-            average_gradients(curr_agent.critic)
-        torch.nn.utils.clip_grad_norm_(curr_agent.critic.parameters(), 0.5)
-        curr_agent.critic_optimizer.step()
-
-        curr_agent.policy_optimizer.zero_grad()
+        if weights is None:
+            vf_loss = MSELoss(actual_value, target_value.detach())
+        else:
+            vf_loss = (weights.view(-1, 1) *
+                       (actual_value - target_value.detach()) ** 2).mean()
+        return vf_loss, (actual_value - target_value).detach().view(-1)
 
+    def _policy_loss(self, obs, agent_i):
+        # policy loss of agent_i
+        curr_agent = self.agents[agent_i]
         if self.discrete_action:
             # Forward pass as if onehot (hard=True) but backprop through a differentiable
             # Gumbel-Softmax sample. The MADDPG paper uses the Gumbel-Softmax trick to backprop
@@ -163,25 +283,166 @@ class MADDPG(object):
         #                       dim=1)
         pol_loss = -curr_agent.critic(vf_in).mean()
         pol_loss += (curr_pol_out**2).mean() * 1e-3
-        pol_loss.backward()
-        if parallel:
-            average_gradients(curr_agent.policy)
-        torch.nn.utils.clip_grad_norm_(curr_agent.policy.parameters(), 0.5)
-        curr_agent.policy_optimizer.step()
+        return pol_loss
+
+    def update_all(self, sample, parallel=False, logger=None, weights=None):
+        """
+        Update parameters of all agents' models based on one shared sample
+        from the replay buffer. Target actions, critic inputs and the
+        policies' actions are computed once for all agents (from the
+        parameters before this round of updates), so each network is
+        evaluated O(1) rather than O(n_agents) times. Each agent's losses
+        only depend on its own networks, so all critics are stepped on the
+        sum of the critic losses, then all policies on the sum of the
+        policy losses
+        Inputs:
+            sample: tuple of (observations, actions, rewards, next
+                    observations, and episode end masks) as for update
+            parallel (bool): If true, will average gradients across threads
+            logger (SummaryWriter from Tensorboard-Pytorch):
+                If passed in, important quantities will be logged
+            weights (torch.Tensor): Importance-sampling weights of the
+                                    sampled transitions in the critic losses
+        Outputs:
+            td_errors (list of torch.Tensor): Critic TD errors of the
+                                              transitions for each agent
+        """
+        if self.stacked:
+            critic_losses = self._stacked_critic_losses
+            policy_losses = self._stacked_policy_losses
+        else:
+            critic_losses = self._critic_losses
+            policy_losses = self._policy_losses
+        for agent in self.agents:
+            agent.critic_optimizer.zero_grad()
+        vf_losses, td_errors = critic_losses(sample, weights=weights)
+        vf_losses.sum().backward()
+        self._step_nets('critic', self.agents, parallel)
+
+        for agent in self.agents:
+            agent.policy_optimizer.zero_grad()
+        pol_losses = policy_losses(sample[0])
+        pol_losses.sum().backward()
+        self._step_nets('policy', self.agents, parallel)
         if logger is not None:
-            logger.add_scalars('agent%i/losses' % agent_i,
-                               {'vf_loss': vf_loss,
-                                'pol_loss': pol_loss},
-                               self.niter)
+            for agent_i in range(self.nagents):
+                logger.add_scalars('agent%i/losses' % agent_i,
+                                   {'vf_loss': vf_losses[agent_i],
+                                    'pol_loss': pol_losses[agent_i]},
+                                   self.niter)
+        return td_errors
+
+    def _critic_losses(self, sample, weights=None):
+        # critic losses (stacked) and TD errors of all agents for update_all
+        obs, acs, rews, next_obs, dones = sample
+        with torch.no_grad():
+            if self.discrete_action: # one-hot encode action
+                all_trgt_acs = [onehot_from_logits(pi(nobs)) for pi, nobs in
+                                zip(self.target_policies, next_obs)]
+            else:
+                all_trgt_acs = [pi(nobs) for pi, nobs in zip(self.target_policies,
+                                                             next_obs)]
+            trgt_vf_in = torch.cat((*next_obs, *all_trgt_acs), dim=1)
+        vf_in = torch.cat((*obs, *acs), dim=1)
+        vf_losses = []
+        td_errors = []
+        for agent_i, curr_agent in enumerate(self.agents):
+            target_value = (rews[agent_i].view(-1, 1) + self.gamma *
+                            curr_agent.target_critic(trgt_vf_in) *
+                            (1 - dones[agent_i].view(-1, 1)))
+            actual_value = curr_agent.critic(vf_in)
+            if weights is None:
+                vf_losses.append(MSELoss(actual_value, target_value))
+            else:
+                vf_losses.append((weights.view(-1, 1) *
+                                  (actual_value - target_value) ** 2).mean())
+            td_errors.append((actual_value - target_value).detach().view(-1))
+        return torch.stack(vf_losses), td_errors
+
+    def _policy_losses(self, obs):
+        # policy losses (stacked) of all agents for update_all
+        all_pol_outs = [pi(ob) for pi, ob in zip(self.policies, obs)]
+        # actions of the other agents in each agent's policy loss
+        if self.discrete_action:
+            all_pol_acs = [onehot_from_logits(out.detach()) for out in
+                           all_pol_outs]
+        else:
+            all_pol_acs = [out.detach() for out in all_pol_outs]
+        pol_losses = []
+        for agent_i, curr_agent in enumerate(self.agents):
+            curr_pol_out = all_pol_outs[agent_i]
+            if self.discrete_action:
+                # see _policy_loss for the Gumbel-Softmax trick
+                curr_pol_vf_in = gumbel_softmax(curr_pol_out, hard=True)
+            else:
+                curr_pol_vf_in = curr_pol_out
+            pol_acs = list(all_pol_acs)
+            pol_acs[agent_i] = curr_pol_vf_in
+            pol_loss = -curr_agent.critic(torch.cat((*obs, *pol_acs),
+                                                    dim=1)).mean()
+            pol_losses.append(pol_loss + (curr_pol_out**2).mean() * 1e-3)
+        return torch.stack(pol_losses)
+
+    def _stacked_critic_losses(self, sample, weights=None):
+        # _critic_losses with all agents' networks evaluated by batched
+        # matrix multiplies
+        obs, acs, rews, next_obs, dones = sample
+        agent = self.agents[0]
+        with torch.no_grad():
+            trgt_outs = agent.target_policy.unstack_outputs(agent.target_policy(
+                agent.target_policy.stack_inputs(next_obs)))
+            if self.discrete_action: # one-hot encode action
+                all_trgt_acs = [onehot_from_logits(out) for out in trgt_outs]
+            else:
+                all_trgt_acs = trgt_outs
+            trgt_vf_in = torch.cat((*next_obs, *all_trgt_acs), dim=1)
+            target_value = (torch.stack(rews) + self.gamma *
+                            agent.target_critic(trgt_vf_in.expand(
+                                self.nagents, -1, -1))[..., 0] *
+                            (1 - torch.stack(dones)))
+        vf_in = torch.cat((*obs, *acs), dim=1)
+        actual_value = agent.critic(vf_in.expand(self.nagents, -1, -1))[..., 0]
+        sq_errors = (actual_value - target_value) ** 2
+        if weights is not None:
+            sq_errors = sq_errors * weights
+        return (sq_errors.mean(dim=1),
+                list((actual_value - target_value).detach()))
+
+    def _stacked_policy_losses(self, obs):
+        # _policy_losses with all agents' networks evaluated by batched
+        # matrix multiplies
+        agent = self.agents[0]
+        pol_outs = agent.policy.unstack_outputs(agent.policy(
+            agent.policy.stack_inputs(obs)))
+        # actions of the other agents in each agent's policy loss
+        if self.discrete_action:
+            all_pol_acs = [onehot_from_logits(out.detach()) for out in pol_outs]
+        else:
+            all_pol_acs = [out.detach() for out in pol_outs]
+        pol_vf_ins = []
+        for agent_i, curr_pol_out in enumerate(pol_outs):
+            if self.discrete_action:
+                # see _policy_loss for the Gumbel-Softmax trick
+                curr_pol_vf_in = gumbel_softmax(curr_pol_out, hard=True)
+            else:
+                curr_pol_vf_in = curr_pol_out
+            pol_acs = list(all_pol_acs)
+            pol_acs[agent_i] = curr_pol_vf_in
+            pol_vf_ins.append(torch.cat((*obs, *pol_acs), dim=1))
+        pol_losses = -agent.critic(torch.stack(pol_vf_ins))[..., 0].mean(dim=1)
+        return pol_losses + torch.stack([(out**2).mean() for out in
+                                         pol_outs]) * 1e-3
 
     def update_all_targets(self):
         """
         Update all target networks (called after normal updates have been
         performed for each agent)
         """
-        for a in self.agents:
-            soft_update(a.target_critic, a.critic, self.tau)
-            soft_update(a.target_policy, a.policy, self.tau)
+        # one fused update over the parameters of all networks
+        soft_update([net for a in self.agents
+                     for net in (a.target_critic, a.target_policy)],
+                    [net for a in self.agents for net in (a.critic, a.policy)],
+                    self.tau)
         self.niter += 1
 
     def prep_training(self, device='gpu'):
@@ -224,6 +485,47 @@ class MADDPG(object):
                 a.policy = fn(a.policy)
             self.pol_dev = device
 
+    def compile(self, mode='compile'):
+        """
+        Compile the networks of all agents (opt-in, networks keep their
+        parameters, so optimizers and saving are unaffected)
+        Inputs:
+            mode (str): 'script' to replace each network by its TorchScript
+                        version (not for stacked networks), or 'compile' to
+                        torch.compile each network in place and also the
+                        loss computations of update and update_all (their
+                        optimizer steps and logging stay eager)
+        """
+        if mode not in ('script', 'compile'):
+            raise ValueError("Unknown compile mode: %s" % mode)
+        if mode == 'script' and self.stacked:
+            raise ValueError("Stacked networks can't be scripted with "
+                             "TorchScript, use mode='compile'")
+        self.scripted = mode == 'script'
+        for a in self.agents:
+            for name in ('policy', 'critic', 'target_policy', 'target_critic'):
+                if mode == 'script':
+                    setattr(a, name, torch.jit.script(getattr(a, name)))
+                else:
+                    getattr(a, name).compile()
+        if mode == 'compile':
+            # only the loss functions, per instance (recompiled for each
+            # agent_i and sample shape)
+            for name in ('_critic_loss', '_policy_loss', '_critic_losses',
+                         '_policy_losses', '_stacked_critic_losses',
+                         '_stacked_policy_losses'):
+                setattr(self, name, torch.compile(getattr(self, name)))
+
+    def freeze(self):
+        """
+        Replace each policy by a copy for inference only, with its input
+        BatchNorm folded into the first layer (see MLPNetwork.freeze). For
+        evaluation and rollout-only processes: frozen policies can no longer
+        be trained or saved. Call before compile
+        """
+        for a in self.agents:
+            a.policy = a.policy.freeze()
+
     def save(self, filename):
         """
         Save trained parameters of all agents into one file
@@ -235,7 +537,8 @@ class MADDPG(object):
 
     @classmethod
     def init_from_env(cls, env, agent_alg="MADDPG", adversary_alg="MADDPG",
-                      gamma=0.95, tau=0.01, lr=0.01, hidden_dim=64):
+                      gamma=0.95, tau=0.01, lr=0.01, hidden_dim=64,
+                      stacked=False):
         """
         Instantiate instance of this class from multi-agent environment
         """
@@ -267,7 +570,8 @@ class MADDPG(object):
                      'hidden_dim': hidden_dim,
                      'alg_types': alg_types,
                      'agent_init_params': agent_init_params,
-                     'discrete_action': discrete_action}
+                     'discrete_action': discrete_action,
+                     'stacked': stacked}
         instance = cls(**init_dict)
         instance.init_dict = init_dict
         return instance
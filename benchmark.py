@@ -0,0 +1,335 @@
+import argparse
+import time
+import numpy as np
+from multiagent.core import World, Agent, Landmark
+
+
+def timeit(fn, n_iters):
+    fn()  # warm up
+    start = time.perf_counter()
+    for _ in range(n_iters):
+        fn()
+    return (time.perf_counter() - start) / n_iters
+
+
+def make_crowded_world(n_agents, n_landmarks, seed=0):
+    """
+    World with agents and landmarks packed closely enough that many pairs
+    are in contact
+    """
+    rng = np.random.RandomState(seed)
+    world = World()
+    world.agents = [Agent() for _ in range(n_agents)]
+    world.landmarks = [Landmark() for _ in range(n_landmarks)]
+    for entity in world.entities:
+        entity.size = 0.05
+        entity.state.p_pos = rng.uniform(-1, +1, world.dim_p) * np.sqrt(
+            len(world.entities)) * 0.05
+        entity.state.p_vel = np.zeros(world.dim_p)
+    world.sync_state()
+    return world
+
+
+def pairwise_loop_force(world):
+    """
+    Reference collision response: per-pair Python loop over
+    World.get_collision_force
+    """
+    entities = world.entities
+    p_force = np.zeros((len(entities), world.dim_p))
+    for a, entity_a in enumerate(entities):
+        for b, entity_b in enumerate(entities):
+            if b <= a: continue
+            f_a, f_b = world.get_collision_force(entity_a, entity_b)
+            if f_a is not None:
+                p_force[a] += f_a
+            if f_b is not None:
+                p_force[b] += f_b
+    return p_force
+
+
+def bench_collision(config):
+    print("%8s %12s %12s %9s %10s" % ('entities', 'loop (ms)', 'batch (ms)',
+                                       'speedup', 'max err'))
+    for n in config.sizes:
+        world = make_crowded_world(n - n // 4, n // 4)
+        zeros = lambda: np.zeros((len(world.entities), world.dim_p))
+        ref = pairwise_loop_force(world)
+        out = world.apply_environment_force(zeros())
+        err = np.abs(ref - out).max()
+        n_iters = max(1, config.n_iters // n)
+        t_loop = timeit(lambda: pairwise_loop_force(world), n_iters)
+        t_batch = timeit(lambda: world.apply_environment_force(zeros()),
+                         n_iters)
+        print("%8i %12.3f %12.3f %8.1fx %10.2e" % (n, t_loop * 1e3,
+                                                   t_batch * 1e3,
+                                                   t_loop / t_batch, err))
+
+
+def bench_broadphase(config):
+    print("%8s %12s %12s %9s %10s" % ('entities', 'dense (ms)', 'grid (ms)',
+                                       'speedup', 'max err'))
+    for n in config.sizes:
+        world = make_crowded_world(n - n // 4, n // 4)
+        zeros = lambda: np.zeros((len(world.entities), world.dim_p))
+        ref = world.apply_environment_force(zeros())
+        t_dense = timeit(lambda: world.apply_environment_force(zeros()),
+                         max(1, config.n_iters // 10))
+        world.collision_broadphase = True
+        world.broadphase_min_colliders = 0  # always use the grid
+        out = world.apply_environment_force(zeros())
+        err = np.abs(ref - out).max()
+        t_grid = timeit(lambda: world.apply_environment_force(zeros()),
+                        max(1, config.n_iters // 10))
+        print("%8i %12.3f %12.3f %8.1fx %10.2e" % (n, t_dense * 1e3,
+                                                   t_grid * 1e3,
+                                                   t_dense / t_grid, err))
+
+
+def bench_batched_env(config):
+    from utils.make_env import make_env, make_batched_env
+    print("%8s %14s %14s %9s" % ('n_envs', 'loop (steps/s)',
+                                  'batch (steps/s)', 'speedup'))
+    for n in config.sizes:
+        envs = [make_env(config.scenario) for _ in range(n)]
+        benv = make_batched_env(config.scenario, n)
+        for env in envs:
+            env.reset()
+        benv.reset()
+        actions = [[sp.sample() if not hasattr(sp, 'n') else
+                    np.eye(sp.n)[np.random.randint(sp.n)]
+                    for sp in benv.action_space] for _ in range(n)]
+        n_iters = max(1, config.n_iters // n)
+        t_loop = timeit(lambda: [env.step(ac) for env, ac in
+                                 zip(envs, actions)], n_iters)
+        t_batch = timeit(lambda: benv.step(actions), n_iters)
+        print("%8i %14.0f %14.0f %8.1fx" % (n, n / t_loop, n / t_batch,
+                                            t_loop / t_batch))
+
+
+def make_update_sample(n_agents, obs_dim, ac_dim, batch_size):
+    import torch
+    return ([torch.randn(batch_size, obs_dim) for _ in range(n_agents)],
+            [torch.eye(ac_dim)[torch.randint(ac_dim, (batch_size,))]
+             for _ in range(n_agents)],
+            [torch.randn(batch_size) for _ in range(n_agents)],
+            [torch.randn(batch_size, obs_dim) for _ in range(n_agents)],
+            [torch.zeros(batch_size) for _ in range(n_agents)])
+
+
+def bench_stacked(config):
+    from algorithms.maddpg import MADDPG
+    obs_dim, ac_dim = 18, 5
+    print("%8s %12s %12s %9s" % ('agents', 'loop (ms)', 'stacked (ms)',
+                                  'speedup'))
+    for n in config.sizes:
+        params = [{'num_in_pol': obs_dim, 'num_out_pol': ac_dim,
+                   'num_in_critic': n * (obs_dim + ac_dim)}] * n
+        sample = make_update_sample(n, obs_dim, ac_dim, config.batch_size)
+        times = []
+        for stacked in (False, True):
+            maddpg = MADDPG(params, ['MADDPG'] * n, discrete_action=True,
+                            stacked=stacked)
+            maddpg.prep_training(device='cpu')
+            times.append(timeit(lambda: maddpg.update_all(sample),
+                                max(1, config.n_iters // (10 * n))))
+        print("%8i %12.3f %12.3f %8.1fx" % (n, times[0] * 1e3, times[1] * 1e3,
+                                            times[0] / times[1]))
+
+
+def onehot_from_logits_loop(logits, eps):
+    """
+    Reference epsilon-greedy one-hot actions: per-row Python selection
+    """
+    import torch
+    argmax_acs = (logits == logits.max(1, keepdim=True)[0]).float()
+    rand_acs = torch.eye(logits.shape[1])[[np.random.choice(
+        range(logits.shape[1]), size=logits.shape[0])]]
+    return torch.stack([argmax_acs[i] if r > eps else rand_acs[i] for i, r in
+                        enumerate(torch.rand(logits.shape[0]))])
+
+
+def sample_gumbel_alloc(shape, eps=1e-20):
+    """
+    Reference Gumbel noise: fresh tensors for every intermediate
+    """
+    import torch
+    U = torch.FloatTensor(*shape).uniform_()
+    return -torch.log(-torch.log(U + eps) + eps)
+
+
+def bench_exploration(config):
+    import torch
+    from utils.misc import onehot_from_logits, sample_gumbel
+    n_acs = 5
+    print("%8s %-10s %12s %12s %9s" % ('batch', 'op', 'old (us)',
+                                        'new (us)', 'speedup'))
+    for n in config.sizes:
+        logits = torch.randn(n, n_acs)
+        gen = torch.Generator().manual_seed(0)
+        out = torch.empty(n, n_acs)
+        n_iters = max(1, config.n_iters * 10 // n)
+        for name, old, new in [
+                ('eps-greedy', lambda: onehot_from_logits_loop(logits, 0.3),
+                 lambda: onehot_from_logits(logits, 0.3, generator=gen)),
+                ('gumbel', lambda: sample_gumbel_alloc((n, n_acs)),
+                 lambda: sample_gumbel((n, n_acs), generator=gen, out=out))]:
+            t_old = timeit(old, n_iters)
+            t_new = timeit(new, n_iters)
+            print("%8i %-10s %12.1f %12.1f %8.1fx" % (n, name, t_old * 1e6,
+                                                     t_new * 1e6,
+                                                     t_old / t_new))
+
+
+def step_variable(maddpg, obs):
+    """
+    Reference rollout actions: Variable-wrapped observations through
+    MADDPG.step under autograd
+    """
+    import torch
+    from torch.autograd import Variable
+    torch_obs = [Variable(torch.Tensor(np.vstack(obs[:, i])),
+                          requires_grad=False) for i in range(maddpg.nagents)]
+    return [ac.data.numpy() for ac in maddpg.step(torch_obs, explore=True)]
+
+
+def bench_act(config):
+    from algorithms.maddpg import MADDPG
+    n_agents, obs_dim, ac_dim = 3, 18, 5
+    print("%8s %12s %12s %9s" % ('n_envs', 'step (us)', 'act (us)',
+                                  'speedup'))
+    for n in config.sizes:
+        params = [{'num_in_pol': obs_dim, 'num_out_pol': ac_dim,
+                   'num_in_critic': n_agents * (obs_dim + ac_dim)}] * n_agents
+        maddpg = MADDPG(params, ['MADDPG'] * n_agents, discrete_action=False)
+        maddpg.prep_rollouts(device='cpu')
+        obs = np.empty((n, n_agents), dtype=object)
+        for k in range(n):
+            for i in range(n_agents):
+                obs[k, i] = np.random.randn(obs_dim)
+        obs_blocks = [np.empty((n, obs_dim), dtype=np.float32)
+                      for _ in range(n_agents)]
+        ac_blocks = [np.empty((n, ac_dim), dtype=np.float32)
+                     for _ in range(n_agents)]
+
+        def act():
+            for i, block in enumerate(obs_blocks):
+                np.stack(obs[:, i], out=block)
+            return maddpg.act(obs_blocks, explore=True, out=ac_blocks)
+        t_step = timeit(lambda: step_variable(maddpg, obs), config.n_iters)
+        t_act = timeit(act, config.n_iters)
+        print("%8i %12.1f %12.1f %8.1fx" % (n, t_step * 1e6, t_act * 1e6,
+                                            t_step / t_act))
+
+
+def bench_freeze(config):
+    from algorithms.maddpg import MADDPG
+    n_agents, obs_dim, ac_dim = 3, 18, 5
+    print("%8s %12s %12s %9s %10s" % ('batch', 'bn (us)', 'frozen (us)',
+                                       'speedup', 'max err'))
+    for n in config.sizes:
+        params = [{'num_in_pol': obs_dim, 'num_out_pol': ac_dim,
+                   'num_in_critic': n_agents * (obs_dim + ac_dim)}] * n_agents
+        maddpg = MADDPG(params, ['MADDPG'] * n_agents, discrete_action=False)
+        maddpg.prep_rollouts(device='cpu')
+        obs = [np.random.randn(n, obs_dim).astype(np.float32)
+               for _ in range(n_agents)]
+        ref = maddpg.act(obs)
+        t_bn = timeit(lambda: maddpg.act(obs), config.n_iters)
+        maddpg.freeze()
+        err = max(np.abs(r - ac).max() for r, ac in zip(ref, maddpg.act(obs)))
+        t_frozen = timeit(lambda: maddpg.act(obs), config.n_iters)
+        print("%8i %12.1f %12.1f %8.1fx %10.2e" % (n, t_bn * 1e6,
+                                                   t_frozen * 1e6,
+                                                   t_bn / t_frozen, err))
+
+
+class FixedSampleBuffer(object):
+    """
+    Replay buffer stand-in for main.update_round that returns one sample
+    """
+    def __init__(self, sample):
+        self.fixed_sample = sample
+
+    def sample(self, batch_size, to_gpu=False):
+        return self.fixed_sample
+
+
+def bench_compile(config):
+    import tempfile
+    import torch
+    from tensorboardX import SummaryWriter
+    from algorithms.maddpg import MADDPG
+    from main import update_round
+    n_agents, obs_dim, ac_dim = 3, 18, 5
+    params = [{'num_in_pol': obs_dim, 'num_out_pol': ac_dim,
+               'num_in_critic': n_agents * (obs_dim + ac_dim)}] * n_agents
+    print("%8s %-10s %-8s %12s %14s %14s" % ('batch', 'updates', 'mode',
+                                             'act (us)', 'round (ms)',
+                                             'first 10 (s)'))
+    log_dir = tempfile.mkdtemp()
+    for n in config.sizes:
+        sample = make_update_sample(n_agents, obs_dim, ac_dim, n)
+        buffer = FixedSampleBuffer(sample)
+        obs = [ob.numpy() for ob in sample[0]]
+        for update_all in (False, True):
+            # the update rounds of main.run, logging included
+            run_config = argparse.Namespace(update_all=update_all,
+                                            prioritized_replay=False,
+                                            batch_size=n)
+            for mode in ('eager', 'script', 'compile'):
+                maddpg = MADDPG(params, ['MADDPG'] * n_agents,
+                                discrete_action=False)
+                logger = SummaryWriter(log_dir)
+                update = lambda: update_round(run_config, maddpg, buffer,
+                                              logger, 0.0)
+                start = time.perf_counter()
+                if mode == 'compile':
+                    torch._dynamo.reset()  # compile caches are per code object
+                if mode != 'eager':
+                    maddpg.compile(mode)
+                # first calls compile (both grad modes for the policies)
+                maddpg.prep_training(device='cpu')
+                for _ in range(10):
+                    update()
+                maddpg.prep_rollouts(device='cpu')
+                maddpg.act(obs)
+                t_first = time.perf_counter() - start
+                t_act = timeit(lambda: maddpg.act(obs), config.n_iters)
+                maddpg.prep_training(device='cpu')
+                t_update = timeit(update, max(1, config.n_iters // 10))
+                logger.close()
+                print("%8i %-10s %-8s %12.1f %14.3f %14.1f" % (
+                    n, 'all' if update_all else 'per agent', mode,
+                    t_act * 1e6, t_update * 1e3, t_first))
+
+
+BENCHMARKS = {'collision': bench_collision,
+              'broadphase': bench_broadphase,
+              'batched_env': bench_batched_env,
+              'stacked': bench_stacked,
+              'exploration': bench_exploration,
+              'act': bench_act,
+              'freeze': bench_freeze,
+              'compile': bench_compile}
+DEFAULT_SIZES = {'exploration': [1, 64, 2048], 'act': [1, 4, 16, 64],
+                 'freeze': [1, 4, 16, 64], 'compile': [4, 1024]}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("benchmark", choices=sorted(BENCHMARKS),
+                        help="Name of benchmark to run")
+    parser.add_argument("--sizes", default=None, type=int, nargs='+',
+                        help="Problem sizes to sweep")
+    parser.add_argument("--n_iters", default=1000, type=int)
+    parser.add_argument("--scenario", default='simple_spread', type=str,
+                        help="Scenario used by environment benchmarks")
+    parser.add_argument("--batch_size", default=1024, type=int,
+                        help="Batch size of training benchmarks")
+    config = parser.parse_args()
+    if config.sizes is None:
+        config.sizes = DEFAULT_SIZES.get(config.benchmark,
+                                         [4, 8, 16, 32, 64, 128])
+
+    BENCHMARKS[config.benchmark](config)
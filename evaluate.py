@@ -1,10 +1,8 @@
 import argparse
-import torch
 import time
 import imageio
 import numpy as np
 from pathlib import Path
-from torch.autograd import Variable
 from utils.make_env import make_env
 from algorithms.maddpg import MADDPG
 
@@ -25,6 +23,7 @@ def run(config):
     maddpg = MADDPG.init_from_save(model_path)
     env = make_env(config.env_id, discrete_action=maddpg.discrete_action)
     maddpg.prep_rollouts(device='cpu')
+    maddpg.freeze()  # fold input normalization, evaluation only
     ifi = 1 / config.fps  # inter-frame interval
 
     for ep_i in range(config.n_episodes):
@@ -36,14 +35,12 @@ def run(config):
         env.render('human')
         for t_i in range(config.episode_length):
             calc_start = time.time()
-            # rearrange observations to be per agent, and convert to torch Variable
-            torch_obs = [Variable(torch.Tensor(obs[i]).view(1, -1),
-                                  requires_grad=False)
+            # rearrange observations to be per agent (batch of one)
+            agent_obs = [np.asarray(obs[i], dtype=np.float32).reshape(1, -1)
                          for i in range(maddpg.nagents)]
-            # get actions as torch Variables
-            torch_actions = maddpg.step(torch_obs, explore=False, parameter_sharing=config.parameter_sharing)
-            # convert actions to numpy arrays
-            actions = [ac.data.numpy().flatten() for ac in torch_actions]
+            actions = [ac.flatten() for ac in
+                       maddpg.act(agent_obs, explore=False,
+                                  parameter_sharing=config.parameter_sharing)]
             print(actions)
             obs, rewards, dones, infos = env.step(actions)
             if config.save_gifs:
@@ -1,20 +1,28 @@
 import argparse
 import torch
+import torch.multiprocessing as mp
 import time
 import os
 import numpy as np
 from gym.spaces import Box, Discrete
 from pathlib import Path
-from torch.autograd import Variable
+from queue import Empty
 from tensorboardX import SummaryWriter
-from utils.make_env import make_env
-from utils.buffer import ReplayBuffer
+from utils.make_env import make_env, make_batched_env
+from utils.buffer import ReplayBuffer, PrioritizedReplayBuffer
 from utils.env_wrappers import SubprocVecEnv, DummyVecEnv
+from utils.misc import SharedPolicies
 from algorithms.maddpg import MADDPG
 
 USE_CUDA = torch.cuda.is_available()
+ACTOR_POLL_INTERVAL = 5.0  # seconds between checks of the actor processes
 
-def make_parallel_env(env_id, n_rollout_threads, seed, discrete_action):
+def make_parallel_env(env_id, n_rollout_threads, seed, discrete_action,
+                      batched=False, shared_memory=False):
+    if batched:
+        np.random.seed(seed)
+        return make_batched_env(env_id, n_rollout_threads,
+                                discrete_action=discrete_action)
     def get_env_fn(rank):
         def init_env():
             env = make_env(env_id, discrete_action=discrete_action)
@@ -25,27 +33,210 @@ def make_parallel_env(env_id, n_rollout_threads, seed, discrete_action):
     if n_rollout_threads == 1:
         return DummyVecEnv([get_env_fn(0)])
     else:
-        return SubprocVecEnv([get_env_fn(i) for i in range(n_rollout_threads)])
- 
-
-def shift_elements_3d_array(tensor_list,axis=0):
-    shifted_list = []
-    # for arr in tensor_list:
-    #     if torch.is_tensor(arr):
-    #         arr_cpu = arr.cpu()
-    #         arr_numpy = arr_cpu.numpy()
-    #         arr_shifted = np.roll(arr_numpy, shift=1, axis=axis)
-    #         shifted_list.append(torch.from_numpy(arr_shifted).to('cuda:0'))
-    if isinstance(tensor_list, np.ndarray):
-        arr_shifted = np.roll(tensor_list, shift=1, axis=axis)
-        shifted_list=arr_shifted
-    elif isinstance(tensor_list, list):
-        arr_numpy = np.array(tensor_list)
-        arr_shifted = np.roll(arr_numpy, shift=1, axis=axis)
-        shifted_list=list(arr_shifted)
+        return SubprocVecEnv([get_env_fn(i) for i in range(n_rollout_threads)],
+                             shared_memory=shared_memory)
+
+
+def rollout_bufs(env, n_envs):
+    # reusable per-agent observation and action blocks for get_actions
+    return ([np.empty((n_envs, obsp.shape[0]), dtype=np.float32)
+             for obsp in env.observation_space],
+            [np.empty((n_envs, acsp.shape[0] if isinstance(acsp, Box)
+                       else acsp.n), dtype=np.float32)
+             for acsp in env.action_space])
+
+
+def get_actions(maddpg, obs, bufs, parameter_sharing, advance_noise=True):
+    # rearrange observations to be per agent, in place into bufs
+    obs_blocks, ac_blocks = bufs
+    for i, block in enumerate(obs_blocks):
+        np.stack(obs[:, i], out=block)
+    agent_actions = maddpg.act(obs_blocks, explore=True,
+                               parameter_sharing=parameter_sharing,
+                               out=ac_blocks, advance_noise=advance_noise)
+    actions = [[ac[i] for ac in agent_actions] for i in range(len(obs))]
+    return agent_actions, actions
+
+
+def noise_scale(config, ep_i):
+    explr_pct_remaining = max(0, config.n_exploration_eps - ep_i) / config.n_exploration_eps
+    return config.final_noise_scale + (config.init_noise_scale - config.final_noise_scale) * explr_pct_remaining
+
+
+def update_round(config, maddpg, replay_buffer, logger, progress):
+    """
+    One round of updates of all agents and their target networks on samples
+    from replay_buffer
+    Inputs:
+        progress (float): Fraction of the episodes done (anneals the
+                          importance-sampling exponent of prioritized replay)
+    """
+    if config.update_all:
+        sample = replay_buffer.sample(config.batch_size, to_gpu=USE_CUDA)
+        maddpg.update_all(sample, logger=logger)
     else:
-        raise TypeError("Unsupported array type")
-    return shifted_list
+        for a_i in range(maddpg.nagents):
+            if config.prioritized_replay:
+                # anneal the importance-sampling exponent to 1
+                beta = config.per_beta + (1 - config.per_beta) * progress
+                sample, weights, inds = replay_buffer.sample_prioritized(
+                    config.batch_size, a_i, beta, to_gpu=USE_CUDA)
+                td_errors = maddpg.update(sample, a_i, logger=logger,
+                                          weights=weights)
+                replay_buffer.update_priorities(
+                    a_i, inds, td_errors.cpu().numpy())
+            else:
+                sample = replay_buffer.sample(config.batch_size,
+                                              to_gpu=USE_CUDA)
+                maddpg.update(sample, a_i, logger=logger)
+    maddpg.update_all_targets()
+
+
+def end_episode(config, maddpg, replay_buffer, logger, run_dir, ep_i,
+                ep_rews):
+    # log the rewards of episodes ep_i onwards and checkpoint every
+    # save_interval episodes
+    for a_i, a_ep_rew in enumerate(ep_rews):
+        logger.add_scalar('agent%i/mean_episode_rewards' % a_i, a_ep_rew, ep_i)
+    for a_i, (rew_mean, rew_std) in enumerate(
+            zip(*replay_buffer.get_reward_stats())):
+        logger.add_scalar('agent%i/buffer_reward_mean' % a_i, rew_mean, ep_i)
+        logger.add_scalar('agent%i/buffer_reward_std' % a_i, rew_std, ep_i)
+
+    if ep_i % config.save_interval < config.n_rollout_threads:
+        os.makedirs(run_dir / 'incremental', exist_ok=True)
+        maddpg.save(run_dir / 'incremental' / ('model_ep%i.pt' % (ep_i + 1)))
+        maddpg.save(run_dir / 'model.pt')
+        replay_buffer.flush()
+        if config.save_buffer:
+            replay_buffer.save(run_dir / 'replay_buffer', background=True)
+
+
+def run_actor(rank, config, init_dict, shared_policies, queue, episodes):
+    """
+    Actor process of run_learner: collects episodes (claimed from the shared
+    counter episodes) with its own envs and a CPU copy of the policies, and
+    puts tagged messages on queue: ('step', transition) for every step,
+    ('episode', (ep_i, ep_rews)) after each episode and ('done', rank) at the
+    end
+    """
+    seed = config.seed + (rank + 1) * config.n_rollout_threads * 1000
+    torch.manual_seed(seed)
+    np.random.seed(seed)
+    torch.set_num_threads(1)
+    env = make_parallel_env(config.env_id, config.n_rollout_threads, seed,
+                            config.discrete_action, batched=config.batched_env)
+    maddpg = MADDPG(**init_dict)
+    maddpg.prep_rollouts(device='cpu')
+    # published weights are fetched into these, and folded for acting
+    policies = maddpg.policies
+    version = -1
+    bufs = rollout_bufs(env, config.n_rollout_threads)
+    while True:
+        with episodes.get_lock():
+            ep_i = episodes.value
+            episodes.value += config.n_rollout_threads
+        if ep_i >= config.n_episodes:
+            break
+        obs = env.reset()
+        maddpg.scale_noise(noise_scale(config, ep_i))
+        maddpg.reset_noise()
+        ep_rews = 0
+        for et_i in range(config.episode_length):
+            new_version = shared_policies.fetch(policies, version)
+            if new_version != version:
+                for a, policy in zip(maddpg.agents, policies):
+                    a.policy = policy.freeze()
+                version = new_version
+            agent_actions, actions = get_actions(maddpg, obs, bufs,
+                                                 config.parameter_sharing)
+            next_obs, rewards, dones, infos = env.step(actions)
+            # the queue pickles in a background thread, after bufs are reused
+            queue.put(('step', (obs, [ac.copy() for ac in agent_actions],
+                                rewards, next_obs, dones)))
+            ep_rews += np.mean(rewards, axis=0)
+            obs = next_obs
+        queue.put(('episode', (ep_i, ep_rews / config.episode_length)))
+    queue.put(('done', rank))
+    env.close()
+
+
+def check_actors(actors):
+    """
+    Raise if an actor process failed, since its messages (and its 'done')
+    would never arrive
+    """
+    for rank, actor in enumerate(actors):
+        if actor.exitcode not in (None, 0):
+            raise RuntimeError("Actor %i exited with code %i" %
+                               (rank, actor.exitcode))
+
+
+def run_learner(config, maddpg, replay_buffer, logger, run_dir):
+    """
+    Train with config.n_actors actor processes (see run_actor) collecting
+    into replay_buffer, while this process updates continuously and
+    publishes the policies through shared memory every
+    config.publish_interval update rounds. Raises RuntimeError if an actor
+    fails, after stopping the others
+    """
+    ctx = mp.get_context('spawn')
+    maddpg.prep_rollouts(device='cpu')
+    shared_policies = SharedPolicies(maddpg.policies, ctx)
+    queue = ctx.Queue()
+    episodes = ctx.Value('i', 0)
+    actors = [ctx.Process(target=run_actor,
+                          args=(rank, config, maddpg.init_dict,
+                                shared_policies, queue, episodes))
+              for rank in range(config.n_actors)]
+    for actor in actors:
+        actor.start()
+    n_running = config.n_actors
+    n_updates = 0
+    last_ep_i = 0
+    try:
+        while n_running > 0:
+            check_actors(actors)
+            # add everything the actors sent so far, waiting for messages
+            # while there is not enough data to sample
+            while n_running > 0:
+                wait = len(replay_buffer) < config.batch_size
+                if not wait and queue.empty():
+                    break
+                try:
+                    kind, data = queue.get(timeout=ACTOR_POLL_INTERVAL)
+                except Empty:
+                    check_actors(actors)
+                    continue
+                if kind == 'step':
+                    replay_buffer.push(*data)
+                elif kind == 'episode':
+                    last_ep_i, ep_rews = data
+                    print("Episodes %i-%i of %i" % (
+                        last_ep_i + 1, last_ep_i + 1 + config.n_rollout_threads,
+                        config.n_episodes))
+                    end_episode(config, maddpg, replay_buffer, logger,
+                                run_dir, last_ep_i, ep_rews)
+                else:  # 'done'
+                    n_running -= 1
+            if len(replay_buffer) < config.batch_size:
+                continue
+            maddpg.prep_training(device='gpu' if USE_CUDA else 'cpu')
+            update_round(config, maddpg, replay_buffer, logger,
+                         last_ep_i / config.n_episodes)
+            n_updates += 1
+            if n_updates % config.publish_interval == 0:
+                shared_policies.publish(maddpg.policies)
+        for actor in actors:
+            actor.join()
+    finally:
+        # on errors, stop the actors still running
+        for actor in actors:
+            if actor.is_alive():
+                actor.terminate()
+            actor.join()
+    print("%i update rounds" % n_updates)
+
 
 def run(config):
     model_dir = Path('./models') / config.env_id / config.model_name
@@ -68,17 +259,65 @@ def run(config):
     np.random.seed(config.seed)
     if not USE_CUDA:
         torch.set_num_threads(config.n_training_threads)
-    env = make_parallel_env(config.env_id, config.n_rollout_threads, config.seed,
-                            config.discrete_action)
+    assert not config.async_rollouts or (config.n_rollout_threads >= 2 and
+                                         not config.batched_env), \
+        "async rollouts need at least 2 subprocess rollout threads"
+    assert not (config.update_all and config.prioritized_replay), \
+        "prioritized replay samples separately for each agent"
+    assert not config.n_actors or not (config.async_rollouts or
+                                       config.shared_memory_env), \
+        "actors step their envs synchronously and without shared memory"
+    # with actor processes, this env only provides the spaces
+    env = make_parallel_env(config.env_id,
+                            1 if config.n_actors else config.n_rollout_threads,
+                            config.seed,
+                            config.discrete_action, batched=config.batched_env,
+                            shared_memory=config.shared_memory_env)
     maddpg = MADDPG.init_from_env(env, agent_alg=config.agent_alg,
                                   adversary_alg=config.adversary_alg,
                                   tau=config.tau,
                                   lr=config.lr,
-                                  hidden_dim=config.hidden_dim)
-    replay_buffer = ReplayBuffer(config.buffer_length, maddpg.nagents,
-                                 [obsp.shape[0] for obsp in env.observation_space],
-                                 [acsp.shape[0] if isinstance(acsp, Box) else acsp.n
-                                  for acsp in env.action_space])
+                                  hidden_dim=config.hidden_dim,
+                                  stacked=config.stacked_networks)
+    if config.compile_mode is not None:
+        maddpg.compile(config.compile_mode)
+    buffer_kwargs = {}
+    if config.prioritized_replay:
+        buffer_kwargs['alpha'] = config.per_alpha
+    replay_buffer = (PrioritizedReplayBuffer if config.prioritized_replay else
+                     ReplayBuffer)(
+        config.buffer_length, maddpg.nagents,
+        [obsp.shape[0] for obsp in env.observation_space],
+        [acsp.shape[0] if isinstance(acsp, Box) else acsp.n
+         for acsp in env.action_space],
+        obs_dtype=config.buffer_obs_dtype,
+        discrete_acs=[isinstance(acsp, Discrete) for acsp in env.action_space],
+        seed=config.seed, path=config.buffer_dir,
+        permute_agents=config.parameter_sharing, **buffer_kwargs)
+    print("Replay buffer uses %.1f MB" % (replay_buffer.nbytes() / 2**20))
+    if config.restore_buffer is not None:
+        replay_buffer.load(config.restore_buffer)
+        print("Restored %i transitions" % len(replay_buffer))
+
+    def finish():
+        maddpg.save(run_dir / 'model.pt')
+        replay_buffer.flush()
+        if config.save_buffer:
+            replay_buffer.save(run_dir / 'replay_buffer')
+        env.close()
+        logger.export_scalars_to_json(str(log_dir / 'summary.json'))
+        logger.close()
+
+    if config.n_actors > 0:
+        run_learner(config, maddpg, replay_buffer, logger, run_dir)
+        finish()
+        return
+
+    def act(obs, bufs, advance_noise=True):
+        return get_actions(maddpg, obs, bufs, config.parameter_sharing,
+                           advance_noise=advance_noise)
+
+    bufs = rollout_bufs(env, config.n_rollout_threads)
     t = 0
     for ep_i in range(0, config.n_episodes, config.n_rollout_threads):
         print("Episodes %i-%i of %i" % (ep_i + 1,
@@ -88,34 +327,40 @@ def run(config):
         # obs.shape = (n_rollout_threads, nagent)(nobs), nobs differs per agent so not tensor
         maddpg.prep_rollouts(device='cpu')
 
-        explr_pct_remaining = max(0, config.n_exploration_eps - ep_i) / config.n_exploration_eps
-        maddpg.scale_noise(config.final_noise_scale + (config.init_noise_scale - config.final_noise_scale) * explr_pct_remaining)
+        maddpg.scale_noise(noise_scale(config, ep_i))
         maddpg.reset_noise()
 
+        if config.async_rollouts:
+            # ping-pong over two halves of the workers: one half steps its
+            # envs while actions are computed for the other half. Group 0
+            # acts first for each step and draws the step's OU noise, which
+            # group 1 reuses, so the noise advances once per env step as in
+            # the synchronous loop. Each half is waited for as a whole, so a
+            # slow env still holds up the rest of its half
+            groups = np.array_split(np.arange(config.n_rollout_threads), 2)
+            group_bufs = [rollout_bufs(env, len(group)) for group in groups]
+            group_actions = [act(obs[groups[0]], group_bufs[0]), None]
+            env.step_async(group_actions[0][1], env_ids=groups[0])
         for et_i in range(config.episode_length):
-            # rearrange observations to be per agent, and convert to torch Variable
-            torch_obs = [Variable(torch.Tensor(np.vstack(obs[:, i])),
-                                  requires_grad=False)
-                         for i in range(maddpg.nagents)]
-            # get actions as torch Variables
-            torch_agent_actions = maddpg.step(torch_obs, explore=True,parameter_sharing=config.parameter_sharing)
-            agent_actions = [ac.data.numpy() for ac in torch_agent_actions] 
-            actions = [[ac[i] for ac in agent_actions] for i in range(config.n_rollout_threads)]
-            next_obs, rewards, dones, infos = env.step(actions)
-            replay_buffer.push(obs, agent_actions, rewards, next_obs, dones)
-            if config.parameter_sharing:
-                obs_t=obs
-                agent_actions_t=agent_actions
-                rewards_t=rewards
-                next_obs_t=next_obs
-                dones_t=dones
-                for i in range(maddpg.nagents):
-                    obs_t=shift_elements_3d_array(obs_t,axis=1)
-                    agent_actions_t=shift_elements_3d_array(agent_actions_t)
-                    rewards_t=shift_elements_3d_array(rewards_t)
-                    next_obs_t=shift_elements_3d_array(next_obs_t,axis=1)
-                    dones_t=shift_elements_3d_array(dones_t)
-                    replay_buffer.push(obs_t, agent_actions_t, rewards_t, next_obs_t, dones_t)
+            if config.async_rollouts:
+                next_obs = np.empty_like(obs)
+                group_actions[1] = act(obs[groups[1]], group_bufs[1],
+                                       advance_noise=False)
+                env.step_async(group_actions[1][1], env_ids=groups[1])
+                for g_i, group in enumerate(groups):
+                    g_next_obs, g_rewards, g_dones, infos = env.step_wait(env_ids=group)
+                    replay_buffer.push(obs[group], group_actions[g_i][0],
+                                       g_rewards, g_next_obs, g_dones)
+                    next_obs[group] = g_next_obs
+                    if g_i == 0 and et_i + 1 < config.episode_length:
+                        group_actions[0] = act(next_obs[group],
+                                               group_bufs[0])
+                        env.step_async(group_actions[0][1], env_ids=group)
+            else:
+                agent_actions, actions = act(obs, bufs)
+                next_obs, rewards, dones, infos = env.step(actions)
+                replay_buffer.push(obs, agent_actions, rewards, next_obs,
+                                   dones)
             obs = next_obs
             t += config.n_rollout_threads
             if (len(replay_buffer) >= config.batch_size and
@@ -127,68 +372,15 @@ def run(config):
                 else:
                     maddpg.prep_training(device='cpu')
                 for u_i in range(config.n_rollout_threads):
-
-                    # if config.parameter_sharing:
-                    #     sample = replay_buffer.sample(config.batch_size, to_gpu=USE_CUDA)
-                        
-                    #     for i in range(maddpg.nagents):                               
-                    #         for a_i in range(maddpg.nagents):
-                    #             maddpg.update(sample, a_i, logger=logger)  
-                    #         maddpg.update_all_targets()
-
-                    #         sample=list(sample)
-                    #         for s_i,sam in enumerate(sample):
-                    #             sample[s_i]=shift_elements_3d_array(sam)
-                    #         sample=tuple(sample)
-                        
-                               
-                    # else:
-                    for a_i in range(maddpg.nagents):
-                        sample = replay_buffer.sample(config.batch_size,
-                                                    to_gpu=USE_CUDA)
-                        maddpg.update(sample, a_i, logger=logger)
-                    maddpg.update_all_targets()
-                    # print("update")
-
-
-
-                        # if config.parameter_sharing:
-                        #     sample=list(sample)
-                        #     for s_i,sam in enumerate(sample):
-                        #         sample[s_i]=shift_elements_3d_array(sam)
-                        #     sample=tuple(sample)
-                        #     maddpg.update(sample, a_i, logger=logger)
-
-
-                        #     sample=list(sample)
-                        #     for s_i,sam in enumerate(sample):
-                        #         sample[s_i]=shift_elements_3d_array(sam)
-                        #     sample=tuple(sample)
-                        #     maddpg.update(sample, a_i, logger=logger)
-
-
-                    
-
-                        # sample=list(sample)
-                        # for s_i,sam in enumerate(sample):
-                        #     sample[s_i]=shift_elements_3d_array(sam)
-                        # sample=tuple(sample)
-                            
+                    update_round(config, maddpg, replay_buffer, logger,
+                                 ep_i / config.n_episodes)
                 maddpg.prep_rollouts(device='cpu')
         ep_rews = replay_buffer.get_average_rewards(
             config.episode_length * config.n_rollout_threads)
-        for a_i, a_ep_rew in enumerate(ep_rews):
-            logger.add_scalar('agent%i/mean_episode_rewards' % a_i, a_ep_rew, ep_i)
+        end_episode(config, maddpg, replay_buffer, logger, run_dir, ep_i,
+                    ep_rews)
 
-        if ep_i % config.save_interval < config.n_rollout_threads:
-            os.makedirs(run_dir / 'incremental', exist_ok=True)
-            maddpg.save(run_dir / 'incremental' / ('model_ep%i.pt' % (ep_i + 1)))
-            maddpg.save(run_dir / 'model.pt')
-
-    maddpg.save(run_dir / 'model.pt')
-    env.close()
-    logger.export_scalars_to_json(str(log_dir / 'summary.json'))
-    logger.close()
+    finish()
 
 
 if __name__ == '__main__':
@@ -203,6 +395,38 @@ if __name__ == '__main__':
     parser.add_argument("--n_rollout_threads", default=1, type=int)
     parser.add_argument("--n_training_threads", default=6, type=int)
     parser.add_argument("--buffer_length", default=int(1e6), type=int)
+    parser.add_argument("--buffer_obs_dtype", default='float32', type=str,
+                        choices=['float16', 'float32', 'float64'],
+                        help="Storage type of observations in the replay buffer")
+    parser.add_argument("--buffer_dir", default=None, type=str,
+                        help="Keep the replay buffer in memory-mapped files " +
+                             "in this directory (reopened if it already " +
+                             "holds a buffer)")
+    parser.add_argument("--save_buffer", action='store_true',
+                        help="Snapshot the replay buffer with each model " +
+                             "checkpoint (in a background thread)")
+    parser.add_argument("--restore_buffer", default=None, type=str,
+                        help="Replay buffer snapshot to start from")
+    parser.add_argument("--update_all", action='store_true',
+                        help="Update all agents on one shared sample per " +
+                             "round, evaluating each policy only once")
+    parser.add_argument("--stacked_networks", action='store_true',
+                        help="Evaluate the networks of all agents together " +
+                             "with batched matrix multiplies (faster for " +
+                             "2-8 agents with similar observation sizes, " +
+                             "warns outside that range)")
+    parser.add_argument("--compile_mode", default=None, type=str,
+                        choices=['script', 'compile'],
+                        help="Compile networks with TorchScript ('script') " +
+                             "or networks and update steps with " +
+                             "torch.compile ('compile')")
+    parser.add_argument("--prioritized_replay", action='store_true',
+                        help="Sample transitions by their critic TD errors")
+    parser.add_argument("--per_alpha", default=0.6, type=float,
+                        help="Priority exponent of prioritized replay")
+    parser.add_argument("--per_beta", default=0.4, type=float,
+                        help="Initial importance-sampling exponent of " +
+                             "prioritized replay (annealed to 1)")
     parser.add_argument("--n_episodes", default=100000, type=int)
     parser.add_argument("--episode_length", default=100, type=int)
     parser.add_argument("--steps_per_update", default=100, type=int)
@@ -225,6 +449,30 @@ if __name__ == '__main__':
     parser.add_argument("--discrete_action",
                         action='store_true')
     parser.add_argument("--parameter_sharing",default=False, type=bool)
+    parser.add_argument("--batched_env", action='store_true',
+                        help="Step all rollout threads as one vectorized " +
+                             "world in this process (scenario must " +
+                             "implement rewards/observations)")
+    parser.add_argument("--async_rollouts", action='store_true',
+                        help="Overlap policy inference for one half of " +
+                             "the rollout threads with env steps of the " +
+                             "other half (needs n_rollout_threads >= 2)")
+    parser.add_argument("--shared_memory_env", action='store_true',
+                        help="Return rollout thread results through " +
+                             "shared memory instead of pickling them")
+    parser.add_argument("--n_actors", default=0, type=int,
+                        help="Collect episodes in this many actor " +
+                             "processes (each with n_rollout_threads envs) " +
+                             "while the main process only learns")
+    parser.add_argument("--publish_interval", default=10, type=int,
+                        help="Update rounds between publishing policy " +
+                             "weights to the actors")
     config = parser.parse_args()
+    if config.stacked_networks and not config.update_all:
+        parser.error("--stacked_networks needs --update_all (stacked " +
+                     "networks are updated for all agents at once)")
+    if config.stacked_networks and config.compile_mode == 'script':
+        parser.error("--stacked_networks can't be scripted with " +
+                     "TorchScript, use --compile_mode compile")
 
     run(config)
@@ -1,12 +1,61 @@
+import itertools
 import numpy as np
 
 # physical/external base state of all entites
 class EntityState(object):
     def __init__(self):
         # physical position
-        self.p_pos = None
+        self._p_pos = None
         # physical velocity
-        self.p_vel = None
+        self._p_vel = None
+        # true once p_pos/p_vel are views into the world's state arrays
+        self._bound = False
+        # world owning the state arrays (its cached distances follow p_pos)
+        self._world = None
+
+    @property
+    def p_pos(self):
+        return self._p_pos
+
+    @p_pos.setter
+    def p_pos(self, value):
+        # write through to world storage so scenario code can keep assigning
+        # (in-place element writes such as p_pos[0] = x bypass this and must
+        # be followed by world.clear_cache())
+        if self._bound:
+            self._p_pos[...] = value
+            self._world.clear_cache()
+        else:
+            self._p_pos = value
+
+    @property
+    def p_vel(self):
+        return self._p_vel
+
+    @p_vel.setter
+    def p_vel(self, value):
+        if self._bound:
+            self._p_vel[...] = value
+        else:
+            self._p_vel = value
+
+    def bind(self, p_pos, p_vel, world):
+        """
+        Make p_pos/p_vel views into rows of the world's state arrays
+        Inputs:
+            p_pos (np.ndarray): Row of World.p_pos owned by this entity
+            p_vel (np.ndarray): Row of World.p_vel owned by this entity
+            world (World): World owning the arrays, whose cached pairwise
+                           quantities are cleared when p_pos is assigned
+        """
+        if self._p_pos is not None:
+            p_pos[...] = self._p_pos
+        if self._p_vel is not None:
+            p_vel[...] = self._p_vel
+        self._p_pos = p_pos
+        self._p_vel = p_vel
+        self._world = world
+        self._bound = True
 
 # state of agents (including communication and internal/mental state)
 class AgentState(EntityState):
@@ -97,12 +146,40 @@ class World(object):
         # contact response parameters
         self.contact_force = 1e+2
         self.contact_margin = 1e-3
+        # opt-in uniform-grid broadphase for large populations: only pairs in
+        # neighbouring cells are evaluated, and pairs further apart than
+        # dist_min + broadphase_cutoff * contact_margin are treated as
+        # non-touching (their softplus force is below 1e-15). Worlds with
+        # fewer colliders than broadphase_min_colliders use the dense kernel,
+        # which is faster for them
+        self.collision_broadphase = False
+        self.broadphase_cutoff = 40.0
+        self.broadphase_min_colliders = 80
+        # struct-of-arrays physical state, one row per entity (agents first,
+        # then landmarks); entity states are views into p_pos / p_vel
+        self._bound_entities = ()
+        self.p_pos = np.zeros((0, self.dim_p))
+        self.p_vel = np.zeros((0, self.dim_p))
+        self.entity_size = np.zeros(0)
+        self.entity_mass = np.zeros(0)
+        self.entity_movable = np.zeros(0, dtype=bool)
+        self.entity_collide = np.zeros(0, dtype=bool)
+        self.entity_max_speed = np.zeros(0)
+        self._entity_index = {}
+        # pairwise deltas / distances, computed lazily once per step
+        self._entity_deltas = None
+        self._entity_dists = None
 
     # return all entities in the world
     @property
     def entities(self):
         return self.agents + self.landmarks
 
+    # return communication state of all agents, one row per agent
+    @property
+    def agent_c(self):
+        return np.array([agent.state.c for agent in self.agents])
+
     # return all agents controllable by external policies
     @property
     def policy_agents(self):
@@ -113,13 +190,65 @@ class World(object):
     def scripted_agents(self):
         return [agent for agent in self.agents if agent.action_callback is not None]
 
+    # (re)allocate state arrays when the entity list changes and refresh
+    # per-entity physical properties (scenarios may change them on reset)
+    def sync_state(self):
+        entities = self.entities
+        if (len(entities) != len(self._bound_entities) or
+                any(a is not b for a, b in zip(entities, self._bound_entities))):
+            self.p_pos = np.zeros((len(entities), self.dim_p))
+            self.p_vel = np.zeros((len(entities), self.dim_p))
+            for i, entity in enumerate(entities):
+                entity.state.bind(self.p_pos[i], self.p_vel[i], self)
+            self._bound_entities = tuple(entities)
+            self._entity_index = {id(entity): i for i, entity in enumerate(entities)}
+        self.sync_properties()
+        self.clear_cache()
+
+    # gather per-entity physical properties into arrays
+    def sync_properties(self):
+        entities = self.entities
+        self.entity_size = np.array([entity.size for entity in entities], dtype=float)
+        self.entity_mass = np.array([entity.mass for entity in entities], dtype=float)
+        self.entity_movable = np.array([entity.movable for entity in entities], dtype=bool)
+        self.entity_collide = np.array([entity.collide for entity in entities], dtype=bool)
+        # np.inf marks entities without a speed limit
+        self.entity_max_speed = np.array(
+            [np.inf if entity.max_speed is None else entity.max_speed
+             for entity in entities], dtype=float)
+
+    # relative positions of all entities: [..., i, j, :] = p_pos[j] - p_pos[i]
+    @property
+    def entity_deltas(self):
+        if self._entity_deltas is None:
+            self._entity_deltas = self.p_pos[..., None, :, :] - self.p_pos[..., :, None, :]
+        return self._entity_deltas
+
+    # pairwise distances between all entities, (..., n_entities, n_entities)
+    @property
+    def entity_dists(self):
+        if self._entity_dists is None:
+            self._entity_dists = np.sqrt(np.sum(np.square(self.entity_deltas), axis=-1))
+        return self._entity_dists
+
+    # cached distance between two entities of this world
+    def distance(self, entity_a, entity_b):
+        return self.entity_dists[self._entity_index[id(entity_a)],
+                                 self._entity_index[id(entity_b)]]
+
+    # drop cached pairwise quantities (state has changed)
+    def clear_cache(self):
+        self._entity_deltas = None
+        self._entity_dists = None
+
     # update state of the world
     def step(self):
+        self.sync_state()
         # set actions for scripted agents 
         for agent in self.scripted_agents:
             agent.action = agent.action_callback(agent, self)
         # gather forces applied to entities
-        p_force = [None] * len(self.entities)
+        p_force = np.zeros_like(self.p_pos)
         # apply agent physical controls
         p_force = self.apply_action_force(p_force)
         # apply environment forces
@@ -132,41 +261,95 @@ class World(object):
 
     # gather agent action forces
     def apply_action_force(self, p_force):
-        # set applied forces
-        for i,agent in enumerate(self.agents):
-            if agent.movable:
-                noise = np.random.randn(*agent.action.u.shape) * agent.u_noise if agent.u_noise else 0.0
-                p_force[i] = agent.action.u + noise                
+        # agents occupy the first rows of the state arrays
+        n_agents = len(self.agents)
+        movable = self.entity_movable[:n_agents]
+        if not movable.any():
+            return p_force
+        p_force[:n_agents][movable] = [agent.action.u for agent in self.agents
+                                       if agent.movable]
+        # motor noise, drawn per agent in the original order
+        for i, agent in enumerate(self.agents):
+            if agent.movable and agent.u_noise:
+                p_force[i] += np.random.randn(*agent.action.u.shape) * agent.u_noise
         return p_force
 
     # gather physical forces acting on entities
     def apply_environment_force(self, p_force):
-        # simple (but inefficient) collision response
-        for a,entity_a in enumerate(self.entities):
-            for b,entity_b in enumerate(self.entities):
-                if(b <= a): continue
-                [f_a, f_b] = self.get_collision_force(entity_a, entity_b)
-                if(f_a is not None):
-                    if(p_force[a] is None): p_force[a] = 0.0
-                    p_force[a] = f_a + p_force[a] 
-                if(f_b is not None):
-                    if(p_force[b] is None): p_force[b] = 0.0
-                    p_force[b] = f_b + p_force[b]        
+        # batched collision response: only movable colliders receive force,
+        # but they are pushed by every collider (movable or not)
+        cols = np.flatnonzero(self.entity_collide)
+        rows = np.flatnonzero(self.entity_collide & self.entity_movable)
+        if len(cols) < 2 or len(rows) == 0:
+            return p_force
+        if (self.collision_broadphase and
+                len(cols) >= self.broadphase_min_colliders):
+            a, b = self.get_broadphase_pairs(rows, cols)
+            force = self.get_collision_forces(a, b)
+            for d in range(self.dim_p):
+                p_force[:, d] += np.bincount(a, weights=force[:, d],
+                                             minlength=len(p_force))
+        else:
+            p_force[..., rows, :] += self.get_collision_forces(
+                rows[:, None], cols[None, :]).sum(axis=-2)
         return p_force
 
+    # get candidate collision pairs (a in rows, b in cols) from a uniform grid
+    # whose cells are as wide as the largest interaction distance, so that
+    # touching entities always sit in the same or adjacent cells
+    def get_broadphase_pairs(self, rows, cols):
+        cell_size = (2 * self.entity_size[cols].max() +
+                     self.broadphase_cutoff * self.contact_margin)
+        cells = np.floor(self.p_pos / cell_size).astype(np.int64)
+        # pad the grid by one cell so that neighbouring keys never wrap
+        lo = cells[cols].min(axis=0) - 1
+        extent = cells[cols].max(axis=0) - lo + 2
+        strides = np.cumprod(np.concatenate(([1], extent[:-1])))
+        col_keys = (cells[cols] - lo) @ strides
+        order = np.argsort(col_keys, kind='stable')
+        sorted_keys = col_keys[order]
+        pairs_a, pairs_b = [], []
+        for offset in itertools.product((-1, 0, 1), repeat=self.dim_p):
+            keys = (cells[rows] + offset - lo) @ strides
+            start = np.searchsorted(sorted_keys, keys, side='left')
+            counts = np.searchsorted(sorted_keys, keys, side='right') - start
+            # expand each row's [start, start + count) slice of the sorted cells
+            first = np.repeat(start - np.cumsum(counts) + counts, counts)
+            pairs_a.append(np.repeat(rows, counts))
+            pairs_b.append(cols[order[first + np.arange(counts.sum())]])
+        a = np.concatenate(pairs_a)
+        b = np.concatenate(pairs_b)
+        distinct = a != b
+        return a[distinct], b[distinct]
+
+    # get collision forces on entities `a` due to entities `b`, where a and b
+    # are broadcastable index arrays (vectorized get_collision_force); any
+    # leading batch axes of p_pos are carried through
+    def get_collision_forces(self, a, b):
+        delta_pos = self.p_pos[..., a, :] - self.p_pos[..., b, :]
+        dist = np.sqrt(np.sum(np.square(delta_pos), axis=-1))
+        # an infinite distance zeroes the force, so entities skip themselves
+        dist[np.broadcast_to(a == b, dist.shape)] = np.inf
+        # minimum allowable distance
+        dist_min = self.entity_size[..., a] + self.entity_size[..., b]
+        # softmax penetration
+        k = self.contact_margin
+        penetration = np.logaddexp(0, -(dist - dist_min)/k)*k
+        return self.contact_force * delta_pos * (penetration / dist)[..., None]
+
     # integrate physical state
     def integrate_state(self, p_force):
-        for i,entity in enumerate(self.entities):
-            if not entity.movable: continue
-            entity.state.p_vel = entity.state.p_vel * (1 - self.damping)
-            if (p_force[i] is not None):
-                entity.state.p_vel += (p_force[i] / entity.mass) * self.dt
-            if entity.max_speed is not None:
-                speed = np.sqrt(np.square(entity.state.p_vel[0]) + np.square(entity.state.p_vel[1]))
-                if speed > entity.max_speed:
-                    entity.state.p_vel = entity.state.p_vel / np.sqrt(np.square(entity.state.p_vel[0]) +
-                                                                  np.square(entity.state.p_vel[1])) * entity.max_speed
-            entity.state.p_pos += entity.state.p_vel * self.dt
+        movable = self.entity_movable
+        p_vel = self.p_vel[..., movable, :] * (1 - self.damping)
+        p_vel += (p_force[..., movable, :] /
+                  self.entity_mass[movable, None]) * self.dt
+        speed = np.sqrt(np.sum(np.square(p_vel), axis=-1))
+        max_speed = np.broadcast_to(self.entity_max_speed[movable], speed.shape)
+        over = speed > max_speed
+        p_vel[over] *= (max_speed[over] / speed[over])[:, None]
+        self.p_vel[..., movable, :] = p_vel
+        self.p_pos[..., movable, :] += p_vel * self.dt
+        self.clear_cache()
 
     def update_agent_state(self, agent):
         # set communication state (directly for now)
@@ -193,4 +376,67 @@ class World(object):
         force = self.contact_force * delta_pos / dist * penetration
         force_a = +force if entity_a.movable else None
         force_b = -force if entity_b.movable else None
-        return [force_a, force_b]
\ No newline at end of file
+        return [force_a, force_b]
+
+
+# K copies of a world stepped in lock-step; physical state is held as
+# (K, n_entities, dim_p) arrays and the entity objects of the template world
+# only supply (shared) physical properties
+class BatchedWorld(World):
+    def __init__(self, world, batch_size):
+        super(BatchedWorld, self).__init__()
+        # inherit dimensions, physics constants and scenario flags
+        self.__dict__.update(vars(world))
+        assert len(self.scripted_agents) == 0, \
+            "scripted agents are not supported in batched worlds"
+        self.batch_size = batch_size
+        # the grid broadphase works on a single world only
+        self.collision_broadphase = False
+        n_agents, n_entities = len(self.agents), len(self.entities)
+        self.p_pos = np.zeros((batch_size, n_entities, self.dim_p))
+        self.p_vel = np.zeros((batch_size, n_entities, self.dim_p))
+        self._agent_c = np.zeros((batch_size, n_agents, self.dim_c))
+        # physical / communication actions, written by the environment
+        self.action_u = np.zeros((batch_size, n_agents, self.dim_p))
+        self.action_c = np.zeros((batch_size, n_agents, self.dim_c))
+        self.sync_properties()
+
+    @property
+    def agent_c(self):
+        return self._agent_c
+
+    # copy the (scenario-initialized) state of a single world into copy k
+    def load_state(self, k, world):
+        world.sync_state()
+        self.p_pos[k] = world.p_pos
+        self.p_vel[k] = world.p_vel
+        self._agent_c[k] = world.agent_c
+        self.clear_cache()
+
+    def sync_state(self):
+        self.sync_properties()
+
+    def step(self):
+        self.sync_state()
+        p_force = np.zeros_like(self.p_pos)
+        p_force = self.apply_action_force(p_force)
+        p_force = self.apply_environment_force(p_force)
+        self.integrate_state(p_force)
+        self.update_agent_states()
+
+    def apply_action_force(self, p_force):
+        n_agents = len(self.agents)
+        movable = self.entity_movable[:n_agents]
+        p_force[:, :n_agents][:, movable] = self.action_u[:, movable]
+        for i, agent in enumerate(self.agents):
+            if agent.movable and agent.u_noise:
+                p_force[:, i] += np.random.randn(self.batch_size, self.dim_p) * agent.u_noise
+        return p_force
+
+    def update_agent_states(self):
+        for i, agent in enumerate(self.agents):
+            if agent.silent:
+                self._agent_c[:, i] = 0.0
+            else:
+                noise = np.random.randn(self.batch_size, self.dim_c) * agent.c_noise if agent.c_noise else 0.0
+                self._agent_c[:, i] = self.action_c[:, i] + noise
@@ -3,6 +3,7 @@ from gym import spaces
 from gym.envs.registration import EnvSpec
 import numpy as np
 from multiagent.multi_discrete import MultiDiscrete
+from multiagent.core import BatchedWorld
 
 # environment for all agents in the multiagent world
 # currently code assumes that no agents will be created/destroyed at runtime!
@@ -13,9 +14,11 @@ class MultiAgentEnv(gym.Env):
 
     def __init__(self, world, reset_callback=None, reward_callback=None,
                  observation_callback=None, info_callback=None,
-                 done_callback=None, shared_viewer=True):
+                 done_callback=None, shared_viewer=True,
+                 rewards_callback=None, observations_callback=None):
 
         self.world = world
+        self.world.sync_state()
         self.agents = self.world.policy_agents
         # set required vectorized gym env property
         self.n = len(world.policy_agents)
@@ -25,6 +28,9 @@ class MultiAgentEnv(gym.Env):
         self.observation_callback = observation_callback
         self.info_callback = info_callback
         self.done_callback = done_callback
+        # optional whole-world callbacks, used in place of the per-agent ones
+        self.rewards_callback = rewards_callback
+        self.observations_callback = observations_callback
         # environment parameters
         self.discrete_action_space = True
         # if true, action is a number 0...N, otherwise action is a one-hot N-dimensional vector
@@ -89,9 +95,15 @@ class MultiAgentEnv(gym.Env):
         # advance world state
         self.world.step()
         # record observation for each agent
+        if self.observations_callback is not None:
+            obs_n = list(self.observations_callback(self.world))
+        if self.rewards_callback is not None:
+            reward_n = list(self.rewards_callback(self.world))
         for agent in self.agents:
-            obs_n.append(self._get_obs(agent))
-            reward_n.append(self._get_reward(agent))
+            if self.observations_callback is None:
+                obs_n.append(self._get_obs(agent))
+            if self.rewards_callback is None:
+                reward_n.append(self._get_reward(agent))
             done_n.append(self._get_done(agent))
 
             info_n['n'].append(self._get_info(agent))
@@ -106,11 +118,14 @@ class MultiAgentEnv(gym.Env):
     def reset(self):
         # reset world
         self.reset_callback(self.world)
+        self.world.sync_state()
         # reset renderer
         self._reset_render()
         # record observations for each agent
-        obs_n = []
         self.agents = self.world.policy_agents
+        if self.observations_callback is not None:
+            return list(self.observations_callback(self.world))
+        obs_n = []
         for agent in self.agents:
             obs_n.append(self._get_obs(agent))
         return obs_n
@@ -340,3 +355,93 @@ class BatchMultiAgentEnv(gym.Env):
         for env in self.env_batch:
             results_n += env.render(mode, close)
         return results_n
+
+
+# steps K copies of a scenario in lock-step on a BatchedWorld, exposing the
+# same reset/step contract as the vectorized envs in utils/env_wrappers.py;
+# requires the scenario's whole-world rewards/observations callbacks
+class BatchedMultiAgentEnv(object):
+    def __init__(self, env, batch_size, rewards_callback, observations_callback):
+        # template env: supplies spaces, action processing flags and a world
+        # that reset_callback initializes before it is copied into the batch
+        self.env = env
+        self.world = BatchedWorld(env.world, batch_size)
+        self.agents = self.world.policy_agents
+        self.n = len(self.agents)
+        self.num_envs = batch_size
+        self.rewards_callback = rewards_callback
+        self.observations_callback = observations_callback
+        self.observation_space = env.observation_space
+        self.action_space = env.action_space
+        if all([hasattr(a, 'adversary') for a in self.agents]):
+            self.agent_types = ['adversary' if a.adversary else 'agent' for a in
+                                self.agents]
+        else:
+            self.agent_types = ['agent' for _ in self.agents]
+
+    def seed(self, seed=None):
+        np.random.seed(seed)
+
+    def step(self, actions):
+        # actions: per env, a list with one action per agent
+        for i, (agent, action_space) in enumerate(zip(self.agents, self.action_space)):
+            self._set_action(np.array([ac[i] for ac in actions], dtype=float),
+                             i, agent, action_space)
+        self.world.step()
+        obs = self._get_obs()
+        rews = np.asarray(self.rewards_callback(self.world), dtype=float)
+        if self.env.shared_reward:
+            rews = np.repeat(rews.sum(axis=1, keepdims=True), self.n, axis=1)
+        dones = np.zeros((self.num_envs, self.n), dtype=bool)
+        infos = tuple({'n': []} for _ in range(self.num_envs))
+        return obs, rews, dones, infos
+
+    def reset(self):
+        for k in range(self.num_envs):
+            self.env.reset_callback(self.env.world)
+            self.world.load_state(k, self.env.world)
+        self.world.sync_state()
+        return self._get_obs()
+
+    def close(self):
+        return
+
+    # observations as a (num_envs, n_agents) object array of per-agent rows;
+    # the stacked (num_envs, obs_dim) array of each agent is kept in obs_n
+    def _get_obs(self):
+        self.obs_n = self.observations_callback(self.world)
+        obs = np.empty((self.num_envs, self.n), dtype=object)
+        for i, agent_obs in enumerate(self.obs_n):
+            for k in range(self.num_envs):
+                obs[k, i] = agent_obs[k]
+        return obs
+
+    # vectorized MultiAgentEnv._set_action for agent i in every copy
+    def _set_action(self, action, i, agent, action_space):
+        if isinstance(action_space, MultiDiscrete):
+            size = action_space.high - action_space.low + 1
+            action = np.split(action, np.cumsum(size)[:-1], axis=1)
+        else:
+            action = [action]
+        if agent.movable:
+            if self.env.force_discrete_action:
+                action[0] = np.eye(action[0].shape[1])[np.argmax(action[0], axis=1)]
+            if self.env.discrete_action_space:
+                u = np.stack([action[0][:, 1] - action[0][:, 2],
+                              action[0][:, 3] - action[0][:, 4]], axis=1)
+                if hasattr(agent, 'right'):
+                    if agent.right == 1:
+                        u[:, 0] = np.maximum(u[:, 0], 0.0)
+                    elif agent.right == -1:
+                        u[:, 0] = np.minimum(u[:, 0], 0.0)
+            else:
+                u = action[0]
+            sensitivity = 5.0
+            if agent.accel is not None:
+                sensitivity = agent.accel
+            self.world.action_u[:, i] = u * sensitivity
+            action = action[1:]
+        if not agent.silent:
+            self.world.action_c[:, i] = action[0]
+            action = action[1:]
+        assert len(action) == 0
@@ -8,3 +8,38 @@ class BaseScenario(object):
     # create initial conditions of the world
     def reset_world(self, world):
         raise NotImplementedError()
+
+# Optionally, a scenario can also implement the whole-world callbacks
+#     rewards(world) -> ndarray (..., n_agents)
+#     observations(world) -> list of ndarray (..., obs_dim), one per agent
+# which MultiAgentEnv prefers over the per-agent reward/observation. They
+# compute everything for a step at once from the world's state arrays and
+# carry any leading batch axes, so the same code serves BatchedWorld. The
+# helpers below build the shared quantities.
+
+# relative positions of all entities: [..., i, j, :] = p_pos[j] - p_pos[i]
+# (cached on the world for the current step)
+def entity_deltas(world):
+    return world.entity_deltas
+
+# pairwise distances between all entities, (..., n_entities, n_entities)
+# (cached on the world for the current step)
+def entity_dists(world):
+    return world.entity_dists
+
+# for each of n agents, the indices of all other agents in order, (n, n - 1)
+def other_agents(n):
+    return np.array([[j for j in range(n) if j != i] for i in range(n)],
+                    dtype=int).reshape(n, n - 1)
+
+# number of agents each agent is in contact with (itself included, as in the
+# per-agent is_collision loops), zero for agents that don't collide
+def agent_collisions(world, dists):
+    n = len(world.agents)
+    size = world.entity_size[:n]
+    contact = dists[..., :n, :n] < size[:, None] + size[None, :]
+    return np.sum(contact, axis=-1) * world.entity_collide[:n]
+
+# flatten the trailing (k, dim) axes of per-agent quantities
+def flat(x):
+    return x.reshape(x.shape[:-2] + (x.shape[-2] * x.shape[-1],))
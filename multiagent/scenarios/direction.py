@@ -1,6 +1,6 @@
 import numpy as np
 from multiagent.core import World, Agent, Landmark
-from multiagent.scenario import BaseScenario
+from multiagent.scenario import BaseScenario, entity_deltas, entity_dists, other_agents, agent_collisions, flat
 import random
 
 class Scenario(BaseScenario):
@@ -134,6 +134,26 @@ class Scenario(BaseScenario):
         return rew
 
 
+
+    # whole-world versions of reward/observation (see multiagent/scenario.py)
+    def rewards(self, world):
+        n = len(world.agents)
+        sq_dists = np.sum(np.square(entity_deltas(world)[..., :n, n:, :]), axis=-1)
+        min_dists_to_landmarks = np.min(sq_dists, axis=-2)
+        rew = -0.1 - np.sum(min_dists_to_landmarks, axis=-1)
+        clear = np.all(min_dists_to_landmarks < 0.05, axis=-1)
+        rew = np.where(clear, 0.0, rew)
+        return np.repeat(rew[..., None], n, axis=-1)
+
+    def observations(self, world):
+        n = len(world.agents)
+        agent_pos = world.p_pos[..., :n, :]
+        right = np.array([[agent.right] for agent in world.agents], dtype=float)
+        obs = np.concatenate([agent_pos,
+                              flat(entity_deltas(world)[..., :n, n:, :]),
+                              np.broadcast_to(right, agent_pos.shape[:-1] + (1,))],
+                             axis=-1)
+        return [obs[..., i, :] for i in range(n)]
     
     def observation(self, agent, world):
         # get positions of all entities in this agent's reference frame
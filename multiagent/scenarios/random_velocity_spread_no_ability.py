@@ -1,7 +1,7 @@
 import numpy as np
 import random
 from multiagent.core import World, Agent, Landmark
-from multiagent.scenario import BaseScenario
+from multiagent.scenario import BaseScenario, entity_deltas, entity_dists, other_agents, agent_collisions, flat
 
 
 class Scenario(BaseScenario):
@@ -59,7 +59,7 @@ class Scenario(BaseScenario):
         occupied_landmarks = 0
         min_dists = 0
         for l in world.landmarks:
-            dists = [np.sqrt(np.sum(np.square(a.state.p_pos - l.state.p_pos))) for a in world.agents]
+            dists = [world.distance(a, l) for a in world.agents]
             min_dists += min(dists)
             rew -= min(dists)
             if min(dists) < (self.landmark_size + self.agent_size)/2:
@@ -81,7 +81,7 @@ class Scenario(BaseScenario):
         # 各ランドマークに対して最も近いエージェントの距離を計算
         min_dists_to_landmarks = []
         for l in world.landmarks:
-            dists = [np.sqrt(np.sum(np.square(a.state.p_pos - l.state.p_pos))) for a in world.agents]
+            dists = [world.distance(a, l) for a in world.agents]
             min_dist = min(dists)
             min_dists_to_landmarks.append(min_dist)
             rew -= min_dist
@@ -124,6 +124,26 @@ class Scenario(BaseScenario):
         return np.concatenate([agent.state.p_pos] + entity_pos + other_pos)
         # return np.concatenate([agent.state.p_vel] + [agent.state.p_pos] + entity_pos + other_pos + comm + other_ability+[np.array([agent.max_speed])])
         
+    # whole-world versions of reward/observation (see multiagent/scenario.py)
+    def rewards(self, world):
+        n = len(world.agents)
+        dists = entity_dists(world)
+        min_dists_to_landmarks = np.min(dists[..., :n, n:], axis=-2)
+        rew = -0.1 - np.sum(min_dists_to_landmarks, axis=-1)
+        # 全てのエージェントが全てのランドマークに到達した場合の報酬調整
+        clear = np.all(min_dists_to_landmarks < 0.03, axis=-1)
+        rew = np.where(clear, 0.0, rew)
+        return rew[..., None] - agent_collisions(world, dists)
+
+    def observations(self, world):
+        n = len(world.agents)
+        deltas = entity_deltas(world)
+        obs = np.concatenate([world.p_pos[..., :n, :],
+                              flat(deltas[..., :n, n:, :]),
+                              flat(deltas[..., np.arange(n)[:, None], other_agents(n), :])],
+                             axis=-1)
+        return [obs[..., i, :] for i in range(n)]
+
     def speed_to_color(self, speed, max_speed):
         # 速度に応じた色を計算する
         norm_speed = speed / max_speed  # 速度を正規化
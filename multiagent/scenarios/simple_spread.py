@@ -1,6 +1,6 @@
 import numpy as np
 from multiagent.core import World, Agent, Landmark
-from multiagent.scenario import BaseScenario
+from multiagent.scenario import BaseScenario, entity_deltas, entity_dists, other_agents, agent_collisions, flat
 
 
 class Scenario(BaseScenario):
@@ -98,3 +98,20 @@ class Scenario(BaseScenario):
             comm.append(other.state.c)
             other_pos.append(other.state.p_pos - agent.state.p_pos)
         return np.concatenate([agent.state.p_vel] + [agent.state.p_pos] + entity_pos + other_pos + comm)
+
+    # whole-world versions of reward/observation (see multiagent/scenario.py)
+    def rewards(self, world):
+        n = len(world.agents)
+        dists = entity_dists(world)
+        rew = -np.sum(np.min(dists[..., :n, n:], axis=-2), axis=-1)
+        return rew[..., None] - agent_collisions(world, dists)
+
+    def observations(self, world):
+        n = len(world.agents)
+        deltas = entity_deltas(world)
+        others = other_agents(n)
+        obs = np.concatenate([world.p_vel[..., :n, :], world.p_pos[..., :n, :],
+                              flat(deltas[..., :n, n:, :]),
+                              flat(deltas[..., np.arange(n)[:, None], others, :]),
+                              flat(world.agent_c[..., others, :])], axis=-1)
+        return [obs[..., i, :] for i in range(n)]
@@ -116,16 +116,15 @@ class Scenario(BaseScenario):
         if agent.adversary:
             collisions = 0
             for a in self.good_agents(world):
-                if self.is_collision(a, agent):
+                if self.is_collision(a, agent, world):
                     collisions += 1
             return collisions
         else:
             return 0
 
 
-    def is_collision(self, agent1, agent2):
-        delta_pos = agent1.state.p_pos - agent2.state.p_pos
-        dist = np.sqrt(np.sum(np.square(delta_pos)))
+    def is_collision(self, agent1, agent2, world):
+        dist = world.distance(agent1, agent2)
         dist_min = agent1.size + agent2.size
         return True if dist < dist_min else False
 
@@ -159,10 +158,10 @@ class Scenario(BaseScenario):
         adversaries = self.adversaries(world)
         if shape:
             for adv in adversaries:
-                rew += 0.1 * np.sqrt(np.sum(np.square(agent.state.p_pos - adv.state.p_pos)))
+                rew += 0.1 * world.distance(agent, adv)
         if agent.collide:
             for a in adversaries:
-                if self.is_collision(a, agent):
+                if self.is_collision(a, agent, world):
                     rew -= 5
         def bound(x):
             if x < 0.9:
@@ -176,9 +175,9 @@ class Scenario(BaseScenario):
             rew -= 2 * bound(x)
 
         for food in world.food:
-            if self.is_collision(agent, food):
+            if self.is_collision(agent, food, world):
                 rew += 2
-        rew += 0.05 * min([np.sqrt(np.sum(np.square(food.state.p_pos - agent.state.p_pos))) for food in world.food])
+        rew += 0.05 * min([world.distance(food, agent) for food in world.food])
 
         return rew
 
@@ -189,11 +188,11 @@ class Scenario(BaseScenario):
         agents = self.good_agents(world)
         adversaries = self.adversaries(world)
         if shape:
-            rew -= 0.1 * min([np.sqrt(np.sum(np.square(a.state.p_pos - agent.state.p_pos))) for a in agents])
+            rew -= 0.1 * min([world.distance(a, agent) for a in agents])
         if agent.collide:
             for ag in agents:
                 for adv in adversaries:
-                    if self.is_collision(ag, adv):
+                    if self.is_collision(ag, adv, world):
                         rew += 5
         return rew
 
@@ -231,10 +230,10 @@ class Scenario(BaseScenario):
         in_forest = [np.array([-1]), np.array([-1])]
         inf1 = False
         inf2 = False
-        if self.is_collision(agent, world.forests[0]):
+        if self.is_collision(agent, world.forests[0], world):
             in_forest[0] = np.array([1])
             inf1= True
-        if self.is_collision(agent, world.forests[1]):
+        if self.is_collision(agent, world.forests[1], world):
             in_forest[1] = np.array([1])
             inf2 = True
 
@@ -249,8 +248,8 @@ class Scenario(BaseScenario):
         for other in world.agents:
             if other is agent: continue
             comm.append(other.state.c)
-            oth_f1 = self.is_collision(other, world.forests[0])
-            oth_f2 = self.is_collision(other, world.forests[1])
+            oth_f1 = self.is_collision(other, world.forests[0], world)
+            oth_f2 = self.is_collision(other, world.forests[1], world)
             if (inf1 and oth_f1) or (inf2 and oth_f2) or (not inf1 and not oth_f1 and not inf2 and not oth_f2) or agent.leader:  #without forest vis
                 other_pos.append(other.state.p_pos - agent.state.p_pos)
                 if not other.adversary:
@@ -264,14 +263,14 @@ class Scenario(BaseScenario):
         prey_forest = []
         ga = self.good_agents(world)
         for a in ga:
-            if any([self.is_collision(a, f) for f in world.forests]):
+            if any([self.is_collision(a, f, world) for f in world.forests]):
                 prey_forest.append(np.array([1]))
             else:
                 prey_forest.append(np.array([-1]))
         # to tell leader when pred are in forest
         prey_forest_lead = []
         for f in world.forests:
-            if any([self.is_collision(a, f) for a in ga]):
+            if any([self.is_collision(a, f, world) for a in ga]):
                 prey_forest_lead.append(np.array([1]))
             else:
                 prey_forest_lead.append(np.array([-1]))
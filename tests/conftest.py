@@ -0,0 +1,6 @@
+import os
+import sys
+
+# skip the interactive deprecation prompt of the multiagent package
+os.environ.setdefault('SUPPRESS_MA_PROMPT', '1')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
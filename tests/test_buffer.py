@@ -0,0 +1,244 @@
+import numpy as np
+import pytest
+from utils.buffer import ReplayBuffer, PrioritizedReplayBuffer, SumTree
+
+N_AGENTS = 3
+OBS_DIMS = [4, 4, 4]
+AC_DIMS = [2, 2, 2]
+
+
+class ReferenceBuffer(object):
+    """
+    Plain ring of transitions (one per stored row) to check ReplayBuffer
+    against
+    """
+    def __init__(self, max_steps):
+        self.max_steps = max_steps
+        self.rows = [None] * max_steps
+        self.count = 0
+
+    def push(self, obs, acs, rews, next_obs, dones):
+        for k in range(obs.shape[0]):
+            self.rows[self.count % self.max_steps] = (
+                [np.array(ob) for ob in obs[k]], [ac[k] for ac in acs],
+                rews[k], [np.array(ob) for ob in next_obs[k]], dones[k])
+            self.count += 1
+
+    def filled(self):
+        return [row for row in self.rows if row is not None]
+
+    def rewards(self):
+        return np.array([row[2] for row in self.filled()])
+
+
+def make_transitions(rng, n_envs, discrete=False):
+    obs = np.empty((n_envs, N_AGENTS), dtype=object)
+    next_obs = np.empty((n_envs, N_AGENTS), dtype=object)
+    for k in range(n_envs):
+        for i in range(N_AGENTS):
+            obs[k, i] = rng.randn(OBS_DIMS[i])
+            next_obs[k, i] = rng.randn(OBS_DIMS[i])
+    if discrete:
+        acs = [np.eye(AC_DIMS[i])[rng.randint(AC_DIMS[i], size=n_envs)]
+               for i in range(N_AGENTS)]
+    else:
+        acs = [rng.uniform(-1, 1, (n_envs, AC_DIMS[i]))
+               for i in range(N_AGENTS)]
+    rews = rng.randn(n_envs, N_AGENTS) * 3 + np.arange(N_AGENTS)
+    dones = rng.rand(n_envs, N_AGENTS) < 0.2
+    return obs, acs, rews, next_obs, dones
+
+
+def fill(buffers, n_pushes, n_envs=3, discrete=False, seed=0):
+    rng = np.random.RandomState(seed)
+    for _ in range(n_pushes):
+        transitions = make_transitions(rng, n_envs, discrete=discrete)
+        for buffer in buffers:
+            buffer.push(*transitions)
+
+
+def check_rows(buffer, ref, inds, shifts=None):
+    # sample fields of buffer at inds against the reference rows (agents
+    # rotated by shifts when the buffer permutes agents)
+    obs, acs, rews, next_obs, dones = buffer.get(inds, norm_rews=False)
+    rows = inds // buffer.n_perms
+    if shifts is None:
+        shifts = inds % buffer.n_perms
+    for n, (row, shift) in enumerate(zip(rows, shifts)):
+        ref_obs, ref_acs, ref_rews, ref_next_obs, ref_dones = ref.rows[row]
+        for i in range(N_AGENTS):
+            j = (i - shift) % N_AGENTS
+            np.testing.assert_allclose(obs[i][n].numpy(), ref_obs[j],
+                                       rtol=1e-6)
+            np.testing.assert_allclose(acs[i][n].numpy(), ref_acs[j],
+                                       rtol=1e-6)
+            np.testing.assert_allclose(rews[i][n].item(), ref_rews[j],
+                                       rtol=1e-6)
+            np.testing.assert_allclose(next_obs[i][n].numpy(),
+                                       ref_next_obs[j], rtol=1e-6)
+            assert dones[i][n].item() == ref_dones[j]
+
+
+@pytest.mark.parametrize('discrete', [False, True])
+def test_ring_wraparound_matches_reference(discrete):
+    # 3 envs per push into 20 rows: writes split at the end of the ring
+    buffer = ReplayBuffer(20, N_AGENTS, OBS_DIMS, AC_DIMS, seed=0,
+                          discrete_acs=[discrete] * N_AGENTS)
+    ref = ReferenceBuffer(20)
+    for n_pushes in (4, 3, 10, 1):
+        fill([buffer, ref], n_pushes, discrete=discrete, seed=n_pushes)
+        assert len(buffer) == len(ref.filled())
+        assert buffer.curr_i == ref.count % 20
+        check_rows(buffer, ref, np.arange(len(buffer)))
+
+
+def test_sample_matches_reference():
+    buffer = ReplayBuffer(20, N_AGENTS, OBS_DIMS, AC_DIMS, seed=0)
+    ref = ReferenceBuffer(20)
+    fill([buffer, ref], 9)
+    for replace in (False, True):
+        buffer.rng = np.random.default_rng(5)
+        inds = buffer.sample_indices(16, replace=replace)
+        assert ((inds >= 0) & (inds < len(buffer))).all()
+        if not replace:
+            assert len(np.unique(inds)) == 16
+        buffer.rng = np.random.default_rng(5)
+        sample = buffer.sample(16, norm_rews=False, replace=replace)
+        for field, ref_field in zip(sample, buffer.get(inds, norm_rews=False)):
+            for x, y in zip(field, ref_field):
+                np.testing.assert_array_equal(x.numpy(), y.numpy())
+        check_rows(buffer, ref, inds)
+
+
+def test_reward_stats_follow_overwrites():
+    buffer = ReplayBuffer(20, N_AGENTS, OBS_DIMS, AC_DIMS, seed=0)
+    ref = ReferenceBuffer(20)
+    for seed in range(6):
+        fill([buffer, ref], 4, seed=seed)
+        ref_rews = ref.rewards().astype(np.float32)
+        mean, std = buffer.get_reward_stats()
+        np.testing.assert_allclose(mean, ref_rews.mean(axis=0), rtol=1e-5,
+                                   atol=1e-6)
+        np.testing.assert_allclose(std, ref_rews.std(axis=0), rtol=1e-5)
+        last = [ref.rows[(ref.count - 1 - k) % 20][2] for k in range(6)]
+        np.testing.assert_allclose(buffer.get_average_rewards(6),
+                                   np.mean(last, axis=0), rtol=1e-5)
+    # normalized sampled rewards use the stats of the stored rewards
+    rews = buffer.get(np.arange(len(buffer)))[2]
+    raw = np.array([row[2] for row in ref.rows], dtype=np.float32)
+    for i in range(N_AGENTS):
+        np.testing.assert_allclose(
+            rews[i].numpy(),
+            (raw[:, i] - raw[:, i].mean()) / raw[:, i].std(), rtol=1e-4,
+            atol=1e-5)
+
+
+def test_permute_agents_remaps_rows():
+    buffer = ReplayBuffer(20, N_AGENTS, OBS_DIMS, AC_DIMS, seed=0,
+                          permute_agents=True)
+    ref = ReferenceBuffer(20)
+    fill([buffer, ref], 9)
+    assert len(buffer) == 20 * N_AGENTS
+    check_rows(buffer, ref, np.arange(len(buffer)))
+    # every agent samples the rewards of all, so the statistics are pooled
+    rews = buffer.get(np.arange(len(buffer)))[2]
+    raw = ref.rewards().astype(np.float32).ravel()
+    for i in range(N_AGENTS):
+        np.testing.assert_allclose(
+            np.sort(rews[i].numpy()), np.sort((raw - raw.mean()) / raw.std()),
+            rtol=1e-4, atol=1e-5)
+
+
+def test_sum_tree_find():
+    rng = np.random.RandomState(0)
+    tree = SumTree(13)
+    values = rng.rand(13)
+    tree.update(np.arange(13), values)
+    np.testing.assert_allclose(tree.total, values.sum())
+    tree.update([2, 7], [0.0, 2.0])
+    values[[2, 7]] = [0.0, 2.0]
+    np.testing.assert_allclose(tree.total, values.sum())
+    targets = rng.rand(1000) * values.sum()
+    np.testing.assert_array_equal(
+        tree.find(targets), np.searchsorted(np.cumsum(values), targets,
+                                            side='right'))
+
+
+def test_prioritized_sampling_is_proportional():
+    alpha, beta = 0.6, 0.4
+    buffer = PrioritizedReplayBuffer(8, N_AGENTS, OBS_DIMS, AC_DIMS,
+                                     alpha=alpha, eps=0.0, seed=0)
+    fill([buffer], 4, n_envs=2)
+    td_errors = np.array([0.1, 0.5, 1.0, 2.0, 4.0, 0.2, 0.3, 3.0])
+    buffer.update_priorities(0, np.arange(8), td_errors)
+    probs = td_errors ** alpha / (td_errors ** alpha).sum()
+    counts = np.zeros(8)
+    for _ in range(200):
+        sample, weights, inds = buffer.sample_prioritized(64, 0, beta,
+                                                          norm_rews=False)
+        counts += np.bincount(inds, minlength=8)
+        expected = (8 * probs[inds]) ** -beta
+        np.testing.assert_allclose(weights.numpy(), expected / expected.max(),
+                                   rtol=1e-5)
+    np.testing.assert_allclose(counts / counts.sum(), probs, atol=0.01)
+    # agent 1's priorities are untouched, and new rows get the maximum
+    assert buffer.trees[1].total == pytest.approx(8.0)
+    fill([buffer], 1, n_envs=1, seed=1)
+    assert buffer.trees[0].tree[buffer.trees[0].capacity] == pytest.approx(
+        4.0 ** alpha)
+
+
+def assert_same_buffer(buffer, other):
+    assert (buffer.filled_i, buffer.curr_i) == (other.filled_i, other.curr_i)
+    for data, other_data in zip(buffer.data, other.data):
+        np.testing.assert_array_equal(data[:buffer.filled_i],
+                                      other_data[:other.filled_i])
+    for stat, other_stat in zip(buffer.get_reward_stats(),
+                                other.get_reward_stats()):
+        np.testing.assert_allclose(stat, other_stat)
+
+
+def test_memmap_reopen(tmp_path):
+    path = str(tmp_path / 'buffer')
+    buffer = ReplayBuffer(20, N_AGENTS, OBS_DIMS, AC_DIMS, path=path)
+    in_memory = ReplayBuffer(20, N_AGENTS, OBS_DIMS, AC_DIMS)
+    fill([buffer, in_memory], 9)
+    buffer.flush()
+    reopened = ReplayBuffer(20, N_AGENTS, OBS_DIMS, AC_DIMS, path=path)
+    assert_same_buffer(reopened, in_memory)
+    fill([reopened, in_memory], 3, seed=1)
+    assert_same_buffer(reopened, in_memory)
+
+
+@pytest.fixture
+def small_chunks(monkeypatch):
+    monkeypatch.setattr(ReplayBuffer, 'snapshot_chunk', 4)
+
+
+@pytest.mark.parametrize('background', [False, True])
+def test_snapshot_round_trip(tmp_path, small_chunks, background):
+    buffer = ReplayBuffer(20, N_AGENTS, OBS_DIMS, AC_DIMS)
+    fill([buffer], 3)
+    buffer.save(str(tmp_path / 'snap'), background=background)
+    # incremental save to the same directory, across the end of the ring
+    fill([buffer], 5, seed=1)
+    buffer.save(str(tmp_path / 'snap'), background=background)
+    buffer.join_save()
+    restored = ReplayBuffer(20, N_AGENTS, OBS_DIMS, AC_DIMS)
+    restored.load(str(tmp_path / 'snap'))
+    assert_same_buffer(restored, buffer)
+
+
+def test_snapshot_after_load_to_new_path(tmp_path, small_chunks):
+    # load -> push -> save elsewhere -> load: the new snapshot must hold
+    # every chunk, not only those written since the load
+    buffer = ReplayBuffer(20, N_AGENTS, OBS_DIMS, AC_DIMS)
+    fill([buffer], 5)
+    buffer.save(str(tmp_path / 'run1'))
+    resumed = ReplayBuffer(20, N_AGENTS, OBS_DIMS, AC_DIMS)
+    resumed.load(str(tmp_path / 'run1'))
+    fill([buffer, resumed], 1, seed=1)
+    resumed.save(str(tmp_path / 'run2'))
+    restored = ReplayBuffer(20, N_AGENTS, OBS_DIMS, AC_DIMS)
+    restored.load(str(tmp_path / 'run2'))
+    assert_same_buffer(restored, buffer)
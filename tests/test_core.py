@@ -0,0 +1,113 @@
+import numpy as np
+import pytest
+from multiagent.core import World, Agent, Landmark
+
+
+def make_world(n_agents, n_landmarks, spread=0.3, seed=0):
+    rng = np.random.RandomState(seed)
+    world = World()
+    world.agents = [Agent() for _ in range(n_agents)]
+    world.landmarks = [Landmark() for _ in range(n_landmarks)]
+    for entity in world.entities:
+        entity.size = rng.uniform(0.02, 0.08)
+        entity.state.p_pos = rng.uniform(-spread, +spread, world.dim_p)
+        entity.state.p_vel = np.zeros(world.dim_p)
+    world.sync_state()
+    return world
+
+
+def loop_force(world):
+    # reference: per-pair Python loop over World.get_collision_force
+    entities = world.entities
+    p_force = np.zeros((len(entities), world.dim_p))
+    for a, entity_a in enumerate(entities):
+        for b, entity_b in enumerate(entities):
+            if b <= a: continue
+            f_a, f_b = world.get_collision_force(entity_a, entity_b)
+            if f_a is not None:
+                p_force[a] += f_a
+            if f_b is not None:
+                p_force[b] += f_b
+    return p_force
+
+
+def batched_force(world, broadphase=False):
+    world.collision_broadphase = broadphase
+    world.broadphase_min_colliders = 0
+    return world.apply_environment_force(np.zeros_like(world.p_pos))
+
+
+def test_collision_kernel_matches_loop():
+    world = make_world(12, 4)
+    # a far-away (non-colliding) pair, plus an immovable agent and a
+    # non-colliding agent inside the crowd
+    world.agents[0].state.p_pos[:] = [10.0, 10.0]
+    world.agents[1].state.p_pos[:] = [10.0, 10.5]
+    world.agents[2].movable = False
+    world.agents[3].collide = False
+    world.sync_state()
+    ref = loop_force(world)
+    out = batched_force(world)
+    np.testing.assert_allclose(out, ref, rtol=1e-10, atol=1e-12)
+    np.testing.assert_allclose(out[[0, 1]], 0, atol=1e-12)
+    assert (out[[2, 3]] == 0).all()
+    assert np.abs(out).sum() > 0  # the crowd does collide
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_collision_kernel_random_flags(seed):
+    rng = np.random.RandomState(seed)
+    world = make_world(20, 10, seed=seed)
+    for entity in world.entities:
+        entity.movable = rng.rand() < 0.7
+        entity.collide = rng.rand() < 0.8
+    world.sync_state()
+    np.testing.assert_allclose(batched_force(world), loop_force(world),
+                               rtol=1e-10, atol=1e-12)
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_broadphase_matches_brute_force(seed):
+    rng = np.random.RandomState(seed)
+    world = make_world(60, 20, spread=0.6, seed=seed)
+    for entity in world.entities:
+        entity.movable = rng.rand() < 0.7
+        entity.collide = rng.rand() < 0.9
+    world.sync_state()
+    # place some entities just either side of grid cell boundaries
+    cell_size = (2 * world.entity_size.max() +
+                 world.broadphase_cutoff * world.contact_margin)
+    straddle = rng.choice(len(world.entities), 20, replace=False)
+    world.p_pos[straddle] = (rng.randint(-3, 3, (20, world.dim_p)) * cell_size +
+                             rng.uniform(-1e-3, 1e-3, (20, world.dim_p)))
+    world.clear_cache()
+    ref = loop_force(world)
+    np.testing.assert_allclose(batched_force(world, broadphase=True), ref,
+                               rtol=1e-9, atol=1e-10)
+    np.testing.assert_allclose(batched_force(world), ref,
+                               rtol=1e-10, atol=1e-12)
+
+
+def test_broadphase_skipped_for_small_worlds():
+    world = make_world(5, 2)
+    world.collision_broadphase = True
+    world.get_broadphase_pairs = None  # would fail if called
+    ref = loop_force(world)
+    np.testing.assert_allclose(
+        world.apply_environment_force(np.zeros_like(world.p_pos)), ref,
+        rtol=1e-10, atol=1e-12)
+
+
+def test_assigning_p_pos_clears_cached_distances():
+    world = make_world(3, 2)
+    agent, landmark = world.agents[0], world.landmarks[1]
+    before = world.distance(agent, landmark)
+    dists = world.entity_dists
+    # as reset_world does between steps, after a cached read
+    agent.state.p_pos = landmark.state.p_pos + np.array([3.0, 4.0])
+    assert world.distance(agent, landmark) == pytest.approx(5.0)
+    assert world.distance(agent, landmark) != pytest.approx(before)
+    assert world.entity_dists is not dists
+    np.testing.assert_allclose(
+        world.entity_dists[0],
+        np.linalg.norm(world.p_pos - world.p_pos[0], axis=-1))
@@ -0,0 +1,96 @@
+import os
+import subprocess
+import sys
+import numpy as np
+import pytest
+
+pytest.importorskip('baselines')
+from utils.make_env import make_env
+from utils.env_wrappers import SubprocVecEnv
+
+
+def get_env_fn(rank):
+    def init_env():
+        env = make_env('simple_spread')
+        np.random.seed(rank)
+        return env
+    return init_env
+
+
+def rollout(shared_memory, n_envs=3, n_steps=5):
+    env = SubprocVecEnv([get_env_fn(i) for i in range(n_envs)],
+                        shared_memory=shared_memory)
+    try:
+        steps = [env.reset()]
+        for t in range(n_steps):
+            actions = [[np.full(5, 0.1 * t) for _ in range(3)]
+                       for _ in range(n_envs)]
+            obs, rews, dones, infos = env.step(actions)
+            # copies, shared memory slots are reused
+            steps.append((np.array([[np.array(ob) for ob in env_obs]
+                                    for env_obs in obs]),
+                          np.array(rews), np.array(dones)))
+        name = env.bufs.shm.name if shared_memory else None
+    finally:
+        env.close()
+    return steps[1:], name
+
+
+def test_shared_memory_matches_pipes():
+    ref, _ = rollout(False)
+    out, name = rollout(True)
+    for (obs, rews, dones), (ref_obs, ref_rews, ref_dones) in zip(out, ref):
+        np.testing.assert_array_equal(obs, ref_obs)
+        np.testing.assert_array_equal(rews, ref_rews)
+        np.testing.assert_array_equal(dones, ref_dones)
+    # the creating process unlinks the block on close
+    assert not os.path.exists(os.path.join('/dev/shm', name.lstrip('/')))
+
+
+def child_pids(pids):
+    # pids of the processes whose parent is in pids (from /proc)
+    children = []
+    for entry in os.listdir('/proc'):
+        try:
+            with open(os.path.join('/proc', entry, 'stat')) as f:
+                stat = f.read()
+        except (OSError, ValueError):
+            continue
+        if int(stat.rsplit(')', 1)[1].split()[1]) in pids:
+            children.append(int(entry))
+    return children
+
+
+def check_shared_memory_outlives_workers():
+    env = SubprocVecEnv([get_env_fn(i) for i in range(3)],
+                        shared_memory=True)
+    env.reset()
+    # workers attached to the block without starting resource trackers of
+    # their own, which would unlink it when the workers exit
+    assert child_pids({p.pid for p in env.ps}) == []
+    for remote in env.remotes:
+        remote.send(('close', None))
+    for p in env.ps:
+        p.join()
+    path = os.path.join('/dev/shm', env.bufs.shm.name.lstrip('/'))
+    assert os.path.exists(path)
+    env.bufs.shm.unlink()
+    assert not os.path.exists(path)
+    # close tolerates the block being gone already
+    env.bufs.close(unlink=True)
+
+
+@pytest.mark.skipif(not os.path.exists('/proc/self/stat'),
+                    reason="needs /proc")
+def test_shared_memory_outlives_workers():
+    # in a fresh interpreter: workers only start trackers of their own when
+    # the creating process hasn't started its tracker yet
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(
+        [root] + sys.path))
+    subprocess.run([sys.executable, os.path.abspath(__file__)], env=env,
+                   check=True)
+
+
+if __name__ == '__main__':
+    check_shared_memory_outlives_workers()
@@ -0,0 +1,217 @@
+import functools
+import warnings
+import numpy as np
+import torch
+import pytest
+from algorithms.maddpg import MADDPG
+
+N_AGENTS, OBS_DIM, AC_DIM = 3, 18, 5
+
+
+def make_maddpg(**kwargs):
+    params = [{'num_in_pol': OBS_DIM, 'num_out_pol': AC_DIM,
+               'num_in_critic': N_AGENTS * (OBS_DIM + AC_DIM)}] * N_AGENTS
+    torch.manual_seed(0)
+    return MADDPG(params, ['MADDPG'] * N_AGENTS, **kwargs)
+
+
+@pytest.mark.parametrize('stacked', [False, True])
+def test_grouped_act_matches_one_call(stacked):
+    # async rollouts act for two halves of the envs of a step; the OU noise
+    # must advance once per step as when acting for all envs at once
+    maddpg = make_maddpg(discrete_action=False, stacked=stacked)
+    maddpg.prep_rollouts(device='cpu')
+    rng = np.random.RandomState(0)
+    steps = [[rng.randn(6, OBS_DIM).astype(np.float32)
+              for _ in range(N_AGENTS)] for _ in range(3)]
+
+    np.random.seed(1)
+    maddpg.reset_noise()
+    ref = [maddpg.act(obs, explore=True) for obs in steps]
+    np.random.seed(1)
+    maddpg.reset_noise()
+    for obs, ref_acs in zip(steps, ref):
+        first = maddpg.act([ob[:3] for ob in obs], explore=True)
+        second = maddpg.act([ob[3:] for ob in obs], explore=True,
+                            advance_noise=False)
+        for a_i in range(N_AGENTS):
+            np.testing.assert_allclose(
+                np.concatenate([first[a_i], second[a_i]]), ref_acs[a_i],
+                rtol=1e-6, atol=1e-6)
+
+
+def copy_into(stacked_net, nets):
+    # load the weights of per-agent MLPs into the (zero padded) stacked net
+    for k, net in enumerate(nets):
+        for l, fc in enumerate([net.fc1, net.fc2, net.fc3]):
+            stacked_net.weights[l].data[
+                k, :fc.in_features, :fc.out_features] = fc.weight.data.t()
+            stacked_net.biases[l].data[k, 0, :fc.out_features] = fc.bias.data
+
+
+NET_NAMES = ['policy', 'critic', 'target_policy', 'target_critic']
+
+
+@pytest.mark.parametrize('discrete', [False, True])
+def test_stacked_update_matches_per_agent(discrete):
+    maddpg = make_maddpg(discrete_action=discrete)
+    stacked = make_maddpg(discrete_action=discrete, stacked=True)
+    for name in NET_NAMES:
+        copy_into(getattr(stacked.agents[0], name),
+                  [getattr(a, name) for a in maddpg.agents])
+    # Adam's first step is about lr * sign(grad), which would amplify the
+    # rounding differences of near-zero gradients, so damp it with a larger eps
+    for agent in maddpg.agents + stacked.agents:
+        for optimizer in (agent.policy_optimizer, agent.critic_optimizer):
+            for group in optimizer.param_groups:
+                group['eps'] = 1e-3
+    maddpg.prep_training(device='cpu')
+    stacked.prep_training(device='cpu')
+    gen = torch.Generator().manual_seed(1)
+    batch = 32
+    sample = ([torch.randn(batch, OBS_DIM, generator=gen)
+               for _ in range(N_AGENTS)],
+              [torch.eye(AC_DIM)[torch.randint(AC_DIM, (batch,),
+                                               generator=gen)]
+               for _ in range(N_AGENTS)],
+              [torch.randn(batch, generator=gen) for _ in range(N_AGENTS)],
+              [torch.randn(batch, OBS_DIM, generator=gen)
+               for _ in range(N_AGENTS)],
+              [(torch.rand(batch, generator=gen) < 0.2).float()
+               for _ in range(N_AGENTS)])
+    # the same seed gives both the same gumbel noise
+    torch.manual_seed(2)
+    td_errors = maddpg.update_all(sample)
+    torch.manual_seed(2)
+    stacked_td_errors = stacked.update_all(sample)
+    maddpg.update_all_targets()
+    stacked.update_all_targets()
+
+    for td, stacked_td in zip(td_errors, stacked_td_errors):
+        np.testing.assert_allclose(stacked_td.detach().numpy(),
+                                   td.detach().numpy(), atol=1e-5)
+    obs, acs = sample[:2]
+    inputs = {'policy': obs, 'target_policy': obs,
+              'critic': [torch.cat((*obs, *acs), dim=1)] * N_AGENTS,
+              'target_critic': [torch.cat((*obs, *acs), dim=1)] * N_AGENTS}
+    for name in NET_NAMES:
+        stacked_out = getattr(stacked.agents[0], name)(
+            torch.stack(inputs[name]))
+        for k, agent in enumerate(maddpg.agents):
+            np.testing.assert_allclose(
+                stacked_out[k].detach().numpy(),
+                getattr(agent, name)(inputs[name][k]).detach().numpy(),
+                atol=1e-5, err_msg=name)
+
+
+def test_stacked_subset_normalizes_like_all_nets():
+    # a subset of nets in training mode uses the batch statistics of its
+    # own inputs, as when all nets are evaluated
+    stacked = make_maddpg(stacked=True).agents[0].policy
+    stacked.train()
+    X = torch.randn(N_AGENTS, 16, OBS_DIM)
+    nets = torch.tensor([2, 0])
+    np.testing.assert_allclose(
+        stacked._normalize(X[nets], nets).detach().numpy(),
+        stacked._normalize(X, None)[nets].detach().numpy(), atol=1e-5)
+
+
+def test_stacked_warns_outside_pay_off_range():
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')
+        make_maddpg(stacked=True)
+    params = [{'num_in_pol': OBS_DIM, 'num_out_pol': AC_DIM,
+               'num_in_critic': 9 * (OBS_DIM + AC_DIM)}] * 9
+    with pytest.warns(UserWarning, match='9 agents'):
+        MADDPG(params, ['MADDPG'] * 9, stacked=True)
+    params = [{'num_in_pol': dim, 'num_out_pol': AC_DIM,
+               'num_in_critic': 60} for dim in (4, 18)]
+    with pytest.warns(UserWarning, match='padding'):
+        MADDPG(params, ['MADDPG'] * 2, stacked=True)
+
+
+def test_stacked_script_is_rejected():
+    maddpg = make_maddpg(stacked=True)
+    with pytest.raises(ValueError):
+        maddpg.compile('script')
+
+
+def test_update_after_inference_act():
+    # gumbel noise drawn under inference mode (act) must not leak into the
+    # policy loss of a same-shaped batch, which autograd has to save
+    maddpg = make_maddpg(discrete_action=True)
+    batch = 8
+    obs = [np.random.randn(batch, OBS_DIM).astype(np.float32)
+           for _ in range(N_AGENTS)]
+    maddpg.prep_rollouts(device='cpu')
+    maddpg.act(obs, explore=True)
+    maddpg.prep_training(device='cpu')
+    sample = ([torch.randn(batch, OBS_DIM) for _ in range(N_AGENTS)],
+              [torch.eye(AC_DIM)[torch.randint(AC_DIM, (batch,))]
+               for _ in range(N_AGENTS)],
+              [torch.randn(batch) for _ in range(N_AGENTS)],
+              [torch.randn(batch, OBS_DIM) for _ in range(N_AGENTS)],
+              [torch.zeros(batch) for _ in range(N_AGENTS)])
+    maddpg.update(sample, 0)
+    maddpg.update_all(sample)
+
+
+def test_scripted_act_after_updates():
+    # the TorchScript executor specializes on grad mode after a few calls,
+    # so acting after several updates must not feed it inference tensors
+    maddpg = make_maddpg(discrete_action=False)
+    maddpg.compile('script')
+    batch = 8
+    sample = ([torch.randn(batch, OBS_DIM) for _ in range(N_AGENTS)],
+              [torch.rand(batch, AC_DIM) for _ in range(N_AGENTS)],
+              [torch.randn(batch) for _ in range(N_AGENTS)],
+              [torch.randn(batch, OBS_DIM) for _ in range(N_AGENTS)],
+              [torch.zeros(batch) for _ in range(N_AGENTS)])
+    maddpg.prep_training(device='cpu')
+    for _ in range(3):
+        maddpg.update_all(sample)
+    maddpg.prep_rollouts(device='cpu')
+    obs = [ob.numpy() for ob in sample[0]]
+    ref = [pi(torch.from_numpy(ob)).detach().numpy()
+           for pi, ob in zip(maddpg.policies, obs)]
+    for acs, ref_acs in zip(maddpg.act(obs), ref):
+        np.testing.assert_allclose(acs, ref_acs, rtol=1e-6)
+
+
+@pytest.mark.parametrize('update_all', [False, True])
+def test_compiled_update_stops_compiling(monkeypatch, tmp_path, update_all):
+    # logging and the update counter stay outside the compiled loss
+    # functions, so new update counts don't recompile them
+    from torch._dynamo.utils import counters
+    from tensorboardX import SummaryWriter
+    # Dynamo tracing and guards as usual, without the slow code generation
+    monkeypatch.setattr(torch, 'compile',
+                        functools.partial(torch.compile, backend='eager'))
+    torch._dynamo.reset()
+    maddpg = make_maddpg(discrete_action=False)
+    eager = make_maddpg(discrete_action=False)
+    maddpg.compile('compile')
+    logger = SummaryWriter(str(tmp_path))
+    sample = ([torch.randn(8, OBS_DIM) for _ in range(N_AGENTS)],
+              [torch.rand(8, AC_DIM) for _ in range(N_AGENTS)],
+              [torch.randn(8) for _ in range(N_AGENTS)],
+              [torch.randn(8, OBS_DIM) for _ in range(N_AGENTS)],
+              [torch.zeros(8) for _ in range(N_AGENTS)])
+    maddpg.prep_training(device='cpu')
+    eager.prep_training(device='cpu')
+    for round_i in range(3):
+        if round_i == 1:
+            n_compiled = counters['stats']['unique_graphs']
+        for m in (maddpg, eager):
+            if update_all:
+                m.update_all(sample, logger=logger)
+            else:
+                for a_i in range(N_AGENTS):
+                    m.update(sample, a_i, logger=logger)
+            m.update_all_targets()
+    assert counters['stats']['unique_graphs'] == n_compiled
+    logger.close()
+    for pi, eager_pi in zip(maddpg.policies, eager.policies):
+        np.testing.assert_allclose(pi(sample[0][0]).detach().numpy(),
+                                   eager_pi(sample[0][0]).detach().numpy(),
+                                   rtol=1e-6)
@@ -1,7 +1,6 @@
-from torch import Tensor
-from torch.autograd import Variable
+import torch
 from torch.optim import Adam
-from .networks import MLPNetwork
+from .networks import MLPNetwork, StackedMLPNetwork
 from .misc import hard_update, gumbel_softmax, onehot_from_logits
 from .noise import OUNoise
 
@@ -52,12 +51,14 @@ class DDPGAgent(object):
         else:
             self.exploration.scale = scale
 
-    def step(self, obs, explore=False):
+    def step(self, obs, explore=False, advance_noise=True):
         """
         Take a step forward in environment for a minibatch of observations
         Inputs:
             obs (PyTorch Variable): Observations for this agent
             explore (boolean): Whether or not to add exploration noise
+            advance_noise (boolean): Draw the next OU noise sample (False
+                                     reuses the last one)
         Outputs:
             action (PyTorch Variable): Actions for this agent
         """
@@ -69,8 +70,8 @@ class DDPGAgent(object):
                 action = onehot_from_logits(action)
         else:  # continuous action
             if explore:
-                action += Variable(Tensor(self.exploration.noise()),
-                                   requires_grad=False)
+                action += torch.from_numpy(
+                    self.exploration.noise(advance=advance_noise))
             action = action.clamp(-1, 1)
         return action
 
@@ -89,3 +90,92 @@ class DDPGAgent(object):
         self.target_critic.load_state_dict(params['target_critic'])
         self.policy_optimizer.load_state_dict(params['policy_optimizer'])
         self.critic_optimizer.load_state_dict(params['critic_optimizer'])
+
+
+class StackedDDPGAgent(DDPGAgent):
+    """
+    DDPG agents of all agents in one object, with the policies, critics and
+    their targets held as StackedMLPNetworks (and one optimizer per stacked
+    network) so that each is evaluated for all agents at once
+    """
+    def __init__(self, num_in_pols, num_out_pols, num_in_critics,
+                 hidden_dim=64, lr=0.01, discrete_action=True):
+        """
+        Inputs:
+            num_in_pols (list of ints): policy input dimensions of each agent
+            num_out_pols (list of ints): policy output dimensions of each
+                                         agent
+            num_in_critics (list of ints): critic input dimensions of each
+                                           agent
+        """
+        self.policy = StackedMLPNetwork(num_in_pols, num_out_pols,
+                                        hidden_dim=hidden_dim,
+                                        constrain_out=True,
+                                        discrete_action=discrete_action)
+        self.critic = StackedMLPNetwork(num_in_critics, [1] * len(num_in_critics),
+                                        hidden_dim=hidden_dim,
+                                        constrain_out=False)
+        self.target_policy = StackedMLPNetwork(num_in_pols, num_out_pols,
+                                               hidden_dim=hidden_dim,
+                                               constrain_out=True,
+                                               discrete_action=discrete_action)
+        self.target_critic = StackedMLPNetwork(num_in_critics,
+                                               [1] * len(num_in_critics),
+                                               hidden_dim=hidden_dim,
+                                               constrain_out=False)
+        hard_update(self.target_policy, self.policy)
+        hard_update(self.target_critic, self.critic)
+        self.policy_optimizer = Adam(self.policy.parameters(), lr=lr)
+        self.critic_optimizer = Adam(self.critic.parameters(), lr=lr)
+        if not discrete_action:
+            self.exploration = [OUNoise(num_out_pol)
+                                for num_out_pol in num_out_pols]
+        else:
+            self.exploration = [0.3] * len(num_out_pols)  # epsilon for eps-greedy
+        self.discrete_action = discrete_action
+
+    def reset_noise(self):
+        if not self.discrete_action:
+            for exploration in self.exploration:
+                exploration.reset()
+
+    def scale_noise(self, scale):
+        if self.discrete_action:
+            self.exploration = [scale] * len(self.exploration)
+        else:
+            for exploration in self.exploration:
+                exploration.scale = scale
+
+    def step(self, observations, explore=False, nets=None,
+             advance_noise=True):
+        """
+        Take a step forward in environment for a minibatch of observations
+        of each agent
+        Inputs:
+            observations (list of PyTorch Variables): Observations for each
+                                                      agent
+            explore (boolean): Whether or not to add exploration noise
+            nets (list of ints): Policy acting for each agent (own if None)
+            advance_noise (boolean): Draw the next OU noise sample (False
+                                     reuses the last one)
+        Outputs:
+            actions (list of PyTorch Variables): Actions for each agent
+        """
+        out = self.policy(self.policy.stack_inputs(observations), nets=nets)
+        if nets is None:
+            nets = range(len(observations))
+        actions = []
+        for i, net in enumerate(nets):
+            action = out[i, :, :self.policy.out_dims[net]]
+            if self.discrete_action:
+                if explore:
+                    action = gumbel_softmax(action, hard=True)
+                else:
+                    action = onehot_from_logits(action)
+            else:  # continuous action
+                if explore:
+                    action += torch.from_numpy(
+                        self.exploration[net].noise(advance=advance_noise))
+                action = action.clamp(-1, 1)
+            actions.append(action)
+        return actions
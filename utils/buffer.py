@@ -1,12 +1,103 @@
+import json
+import os
+import threading
 import numpy as np
-from torch import Tensor
-from torch.autograd import Variable
+import torch
+
+
+class RunningStats(object):
+    """
+    Mean and variance of a changing set of samples with one entry per column,
+    kept up to date as batches of rows are added or removed (Welford/Chan
+    updates), so they never need a pass over all stored data
+    """
+    def __init__(self, ncols):
+        self.count = 0
+        self.mean = np.zeros(ncols)
+        self.m2 = np.zeros(ncols)  # sum of squared deviations from the mean
+
+    def add(self, x):
+        n_b = x.shape[0]
+        if n_b == 0:
+            return
+        mean_b = x.mean(axis=0)
+        m2_b = ((x - mean_b) ** 2).sum(axis=0)
+        n = self.count + n_b
+        delta = mean_b - self.mean
+        self.mean = self.mean + delta * n_b / n
+        self.m2 = self.m2 + m2_b + delta ** 2 * self.count * n_b / n
+        self.count = n
+
+    def remove(self, x):
+        n_b = x.shape[0]
+        n_a = self.count - n_b
+        if n_a <= 0:
+            self.__init__(self.mean.shape[0])
+            return
+        mean_b = x.mean(axis=0)
+        m2_b = ((x - mean_b) ** 2).sum(axis=0)
+        mean_a = (self.count * self.mean - n_b * mean_b) / n_a
+        delta = mean_b - mean_a
+        self.m2 = np.maximum(self.m2 - m2_b - delta ** 2 * n_a * n_b /
+                             self.count, 0)
+        self.mean = mean_a
+        self.count = n_a
+
+    @property
+    def std(self):
+        return np.sqrt(self.m2 / max(self.count, 1))
+
+
+class SumTree(object):
+    """
+    Array-backed binary tree whose internal nodes hold the sum of their
+    children, for sampling leaves in proportion to their values. Node 1 is
+    the root and the children of node i are 2i and 2i + 1
+    """
+    def __init__(self, size):
+        self.depth = int(np.ceil(np.log2(max(size, 1))))
+        self.capacity = 1 << self.depth  # first leaf
+        self.tree = np.zeros(2 * self.capacity)
+
+    @property
+    def total(self):
+        return self.tree[1]
+
+    def update(self, inds, values):
+        """
+        Set the leaves inds to values and recompute their ancestors, one
+        level of the tree per step for the whole batch
+        """
+        nodes = np.asarray(inds) + self.capacity
+        self.tree[nodes] = values
+        for _ in range(self.depth):
+            nodes = np.unique(nodes // 2)
+            self.tree[nodes] = self.tree[2 * nodes] + self.tree[2 * nodes + 1]
+
+    def find(self, values):
+        """
+        Leaves at which the cumulative sum of leaf values reaches values
+        """
+        nodes = np.ones(len(values), dtype=np.int64)
+        values = np.array(values, dtype=np.float64)
+        for _ in range(self.depth):
+            left = self.tree[2 * nodes]
+            right = values >= left
+            values -= left * right
+            nodes = 2 * nodes + right
+        return nodes - self.capacity
+
 
 class ReplayBuffer(object):
     """
     Replay Buffer for multi-agent RL with parallel rollouts
     """
-    def __init__(self, max_steps, num_agents, obs_dims, ac_dims):
+    snapshot_chunk = 1 << 16  # rows per file of a snapshot (see save)
+
+    def __init__(self, max_steps, num_agents, obs_dims, ac_dims,
+                 obs_dtype=np.float32, rew_dtype=np.float32,
+                 done_dtype=np.uint8, discrete_acs=None, seed=None,
+                 path=None, permute_agents=False):
         """
         Inputs:
             max_steps (int): Maximum number of timepoints to store in buffer
@@ -14,83 +105,454 @@ class ReplayBuffer(object):
             obs_dims (list of ints): number of obervation dimensions for each
                                      agent
             ac_dims (list of ints): number of action dimensions for each agent
+            obs_dtype (np.dtype): Storage type of (next) observations
+            rew_dtype (np.dtype): Storage type of rewards
+            done_dtype (np.dtype): Storage type of episode end masks
+            discrete_acs (list of bools): Whether each agent's actions are
+                                          one-hot; these are stored as
+                                          indices and expanded on sample
+            seed (int): Seed of the generator used to sample indices
+            path (str): Directory of memory-mapped files to keep the buffer
+                        in (None keeps it in memory). A buffer already
+                        saved there (see flush) is reopened
+            permute_agents (bool): Also sample every cyclic rotation of the
+                                   agents of each stored transition
+                                   (parameter sharing augmentation), by
+                                   remapping columns in the sample gather
         """
         self.max_steps = max_steps
         self.num_agents = num_agents
-        self.obs_buffs = []
-        self.ac_buffs = []
-        self.rew_buffs = []
-        self.next_obs_buffs = []
-        self.done_buffs = []
-        for odim, adim in zip(obs_dims, ac_dims):
-            self.obs_buffs.append(np.zeros((max_steps, odim)))
-            self.ac_buffs.append(np.zeros((max_steps, adim)))
-            self.rew_buffs.append(np.zeros(max_steps))
-            self.next_obs_buffs.append(np.zeros((max_steps, odim)))
-            self.done_buffs.append(np.zeros(max_steps))
-
+        if discrete_acs is None:
+            discrete_acs = [False] * num_agents
+        self.discrete_acs = discrete_acs
+        if permute_agents and (len(set(obs_dims)) > 1 or len(set(ac_dims)) > 1
+                               or len(set(discrete_acs)) > 1):
+            raise ValueError("Permuted agents must have the same observation "
+                             "and action spaces")
+        self.n_perms = num_agents if permute_agents else 1  # samples per row
+        self.rng = np.random.default_rng(seed)
+        self.path = path
+        meta = None
+        if path is not None:
+            os.makedirs(path, exist_ok=True)
+            if os.path.exists(os.path.join(path, 'meta.json')):
+                with open(os.path.join(path, 'meta.json')) as f:
+                    meta = json.load(f)
+        # packed storage: one row per transition, with all fields of the same
+        # dtype in one array so that sample gathers once per array instead of
+        # once per field and agent. Columns are ordered by field, then agent.
+        # Discrete actions are stored as indices in arrays of their own and
+        # expanded to one-hot on sample
+        fields = []  # (field, agent, storage dtype, is index)
+        for field in ('obs', 'acs', 'rews', 'next_obs', 'dones'):
+            for agent_i in range(num_agents):
+                discrete = field == 'acs' and discrete_acs[agent_i]
+                if field in ('obs', 'next_obs'):
+                    dtype = obs_dtype
+                elif field == 'acs':
+                    dtype = (np.min_scalar_type(ac_dims[agent_i] - 1)
+                             if discrete else np.float32)
+                else:
+                    dtype = rew_dtype if field == 'rews' else done_dtype
+                fields.append((field, agent_i, np.dtype(dtype), discrete))
+        widths = {'obs': obs_dims, 'next_obs': obs_dims, 'acs': ac_dims,
+                  'rews': [1] * num_agents, 'dones': [1] * num_agents}
+        views = {field: [None] * num_agents for field in widths}
+        self.data = []  # packed storage arrays
+        self.data_cols = []  # output columns filled from each array
+        self.data_onehot = []  # one-hot offsets of index arrays (else None)
+        self.data_perms = []  # column order of each agent rotation (or None)
+        self.out_cols = {}  # (field, agent) -> output columns
+        out_width = 0
+        for key in sorted(set((dtype.str, discrete)
+                              for _, _, dtype, discrete in fields)):
+            group = [(field, agent_i) for field, agent_i, dtype, discrete
+                     in fields if (dtype.str, discrete) == key]
+            dtype, discrete = np.dtype(key[0]), key[1]
+            ncols = (len(group) if discrete else
+                     sum(widths[f][i] for f, i in group))
+            data = self._alloc(len(self.data), (max_steps, ncols), dtype,
+                               reopen=meta is not None)
+            col = 0
+            onehot = []
+            storage_cols = {}
+            group_start = out_width
+            for field, agent_i in group:
+                width = widths[field][agent_i]
+                storage_cols[(field, agent_i)] = np.arange(
+                    col, col + (1 if discrete else width))
+                if discrete:
+                    views[field][agent_i] = data[:, col]
+                    onehot.append(out_width - group_start)
+                    col += 1
+                elif field in ('rews', 'dones'):
+                    views[field][agent_i] = data[:, col]
+                    col += 1
+                else:
+                    views[field][agent_i] = data[:, col:col + width]
+                    col += width
+                self.out_cols[(field, agent_i)] = (
+                    out_width if field in ('rews', 'dones') else
+                    slice(out_width, out_width + width))
+                out_width += width
+            self.data.append(data)
+            self.data_cols.append(slice(group_start, out_width))
+            self.data_onehot.append(np.array(onehot) if discrete else None)
+            if permute_agents:
+                # rotation by shift gives agent i the columns of agent i - shift
+                self.data_perms.append(np.array(
+                    [np.concatenate([storage_cols[(f, (i - shift) % num_agents)]
+                                     for f, i in group])
+                     for shift in range(num_agents)]))
+            else:
+                self.data_perms.append(None)
+        self.out_width = out_width
+        self.obs_buffs = views['obs']
+        self.ac_buffs = views['acs']
+        self.rew_buffs = views['rews']
+        self.next_obs_buffs = views['next_obs']
+        self.done_buffs = views['dones']
+        self.out = None  # reusable sample output
+        self.copy_event = None  # marks the end of the last host-to-GPU copy
+        self.rew_stats = RunningStats(num_agents)  # of the stored rewards
+        # snapshot chunks written since the last save, and the directory of
+        # that save (or of the last load)
+        self.dirty = np.zeros(-(-max_steps // self.snapshot_chunk), dtype=bool)
+        self.snapshot_path = None
+        self.save_thread = None
 
         self.filled_i = 0  # index of first empty location in buffer (last index when full)
         self.curr_i = 0  # current index to write to (ovewrite oldest data)
+        if meta is not None:
+            self._set_state(meta)
+            self.dirty[:] = True
 
     def __len__(self):
-        return self.filled_i
+        return self.filled_i * self.n_perms
+
+    def _alloc(self, i, shape, dtype, reopen=False):
+        if self.path is None:
+            return np.zeros(shape, dtype=dtype)
+        fname = os.path.join(self.path, 'data%i.npy' % i)
+        if not reopen:
+            # sparse file, so pages are only allocated once written
+            return np.lib.format.open_memmap(fname, mode='w+', dtype=dtype,
+                                             shape=shape)
+        data = np.load(fname, mmap_mode='r+')
+        if data.shape != shape or data.dtype != dtype:
+            raise ValueError("%s does not match the buffer layout (%s %s)" %
+                             (fname, shape, np.dtype(dtype)))
+        return data
+
+    def flush(self):
+        """
+        Write a memory-mapped buffer to disk, together with the state needed
+        to reopen it
+        """
+        if self.path is None:
+            return
+        for data in self.data:
+            data.flush()
+        _write_json(os.path.join(self.path, 'meta.json'), self._get_state())
+
+    def _get_state(self):
+        return {'filled_i': self.filled_i, 'curr_i': self.curr_i,
+                'rew_count': self.rew_stats.count,
+                'rew_mean': self.rew_stats.mean.tolist(),
+                'rew_m2': self.rew_stats.m2.tolist()}
+
+    def _set_state(self, state):
+        self.filled_i = state['filled_i']
+        self.curr_i = state['curr_i']
+        self.rew_stats.count = state['rew_count']
+        self.rew_stats.mean = np.array(state['rew_mean'])
+        self.rew_stats.m2 = np.array(state['rew_m2'])
+
+    def save(self, path, compress=True, background=False):
+        """
+        Snapshot the filled part of the buffer into directory path as one
+        .npz file per chunk of snapshot_chunk rows. Saving is incremental:
+        when path is the directory of the previous save or load, only chunks
+        written since then are rewritten; any other path gets every chunk
+        Inputs:
+            path (str): Directory of the snapshot
+            compress (bool): Whether to compress the chunk files
+            background (bool): Write the files in a background thread, so
+                               only copying the changed chunks blocks
+        """
+        self.join_save()
+        path = os.path.abspath(path)
+        os.makedirs(path, exist_ok=True)
+        if path != self.snapshot_path:
+            self.dirty[:] = True
+        self.snapshot_path = path
+        state = self._get_state()
+        state['layout'] = [[list(data.shape), data.dtype.str]
+                           for data in self.data]
+        chunks = []
+        n_chunks = -(-self.filled_i // self.snapshot_chunk)
+        for chunk_i in np.flatnonzero(self.dirty[:n_chunks]):
+            rows = slice(chunk_i * self.snapshot_chunk,
+                         min((chunk_i + 1) * self.snapshot_chunk, self.filled_i))
+            chunks.append((chunk_i, [np.array(data[rows]) for data in self.data]))
+        self.dirty[:] = False
+        savez = np.savez_compressed if compress else np.savez
+
+        def write():
+            for chunk_i, arrs in chunks:
+                savez(os.path.join(path, 'chunk%i.npz' % chunk_i), *arrs)
+            _write_json(os.path.join(path, 'meta.json'), state)
+        if background:
+            self.save_thread = threading.Thread(target=write, daemon=True)
+            self.save_thread.start()
+        else:
+            write()
+
+    def join_save(self):
+        """
+        Wait for a background save to finish
+        """
+        if self.save_thread is not None:
+            self.save_thread.join()
+            self.save_thread = None
+
+    def load(self, path):
+        """
+        Restore a snapshot written by save into this buffer, which must have
+        the same layout
+        """
+        with open(os.path.join(path, 'meta.json')) as f:
+            state = json.load(f)
+        layout = [[list(data.shape), data.dtype.str] for data in self.data]
+        if state['layout'] != layout:
+            raise ValueError("Snapshot in %s does not match the buffer layout"
+                             % path)
+        n_chunks = -(-state['filled_i'] // self.snapshot_chunk)
+        for chunk_i in range(n_chunks):
+            rows = slice(chunk_i * self.snapshot_chunk,
+                         min((chunk_i + 1) * self.snapshot_chunk,
+                             state['filled_i']))
+            with np.load(os.path.join(path, 'chunk%i.npz' % chunk_i)) as arrs:
+                for i, data in enumerate(self.data):
+                    data[rows] = arrs['arr_%i' % i]
+        self._set_state(state)
+        self.dirty[:] = False
+        self.snapshot_path = os.path.abspath(path)
+
+    def nbytes(self):
+        """
+        Memory footprint of the stored data in bytes
+        """
+        return sum(data.nbytes for data in self.data)
 
     def push(self, observations, actions, rewards, next_observations, dones):
         nentries = observations.shape[0]  # handle multiple parallel environments
-        if self.curr_i + nentries > self.max_steps:
-            rollover = self.max_steps - self.curr_i # num of indices to roll over
-            for agent_i in range(self.num_agents):
-                self.obs_buffs[agent_i] = np.roll(self.obs_buffs[agent_i],
-                                                  rollover, axis=0)
-                self.ac_buffs[agent_i] = np.roll(self.ac_buffs[agent_i],
-                                                 rollover, axis=0)
-                self.rew_buffs[agent_i] = np.roll(self.rew_buffs[agent_i],
-                                                  rollover)
-                self.next_obs_buffs[agent_i] = np.roll(
-                    self.next_obs_buffs[agent_i], rollover, axis=0)
-                self.done_buffs[agent_i] = np.roll(self.done_buffs[agent_i],
-                                                   rollover)
-            self.curr_i = 0
-            self.filled_i = self.max_steps
+        # ring buffer: write in place, splitting the write at the end of the
+        # buffer and overwriting the oldest data
+        n_first = min(nentries, self.max_steps - self.curr_i)
+        splits = [(self.curr_i, 0, n_first), (0, n_first, nentries)]
+        rewards = np.asarray(rewards, dtype=self.rew_buffs[0].dtype)
+        for start, src_start, src_end in splits:
+            if src_end == src_start:
+                continue
+            end = start + src_end - src_start
+            self.dirty[start // self.snapshot_chunk:
+                       (end - 1) // self.snapshot_chunk + 1] = True
+            if start < self.filled_i:  # rewards about to be overwritten
+                self.rew_stats.remove(np.stack(
+                    [rew_buff[start:end] for rew_buff in self.rew_buffs], axis=1))
+            self.rew_stats.add(rewards[src_start:src_end])
         for agent_i in range(self.num_agents):
-            self.obs_buffs[agent_i][self.curr_i:self.curr_i + nentries] = np.vstack(
-                observations[:, agent_i])
-            # actions are already batched by agent, so they are indexed differently
-            self.ac_buffs[agent_i][self.curr_i:self.curr_i + nentries] = actions[agent_i]
-            self.rew_buffs[agent_i][self.curr_i:self.curr_i + nentries] = rewards[:, agent_i]
-            self.next_obs_buffs[agent_i][self.curr_i:self.curr_i + nentries] = np.vstack(
-                next_observations[:, agent_i])
-            self.done_buffs[agent_i][self.curr_i:self.curr_i + nentries] = dones[:, agent_i]
-        self.curr_i += nentries
-        if self.filled_i < self.max_steps:
-            self.filled_i += nentries
-        if self.curr_i == self.max_steps:
-            self.curr_i = 0
-
-    def sample(self, N, to_gpu=False, norm_rews=True):
-        inds = np.random.choice(np.arange(self.filled_i), size=N,
-                                replace=False)
-        if to_gpu:
-            cast = lambda x: Variable(Tensor(x), requires_grad=False).cuda()
-        else:
-            cast = lambda x: Variable(Tensor(x), requires_grad=False)
+            obs = np.vstack(observations[:, agent_i])
+            next_obs = np.vstack(next_observations[:, agent_i])
+            acs = actions[agent_i]
+            if self.discrete_acs[agent_i]:
+                acs = np.argmax(acs, axis=1)
+            for start, src_start, src_end in splits:
+                if src_end == src_start:
+                    continue
+                end = start + src_end - src_start
+                self.obs_buffs[agent_i][start:end] = obs[src_start:src_end]
+                # actions are already batched by agent, so they are indexed differently
+                self.ac_buffs[agent_i][start:end] = acs[src_start:src_end]
+                self.rew_buffs[agent_i][start:end] = rewards[src_start:src_end, agent_i]
+                self.next_obs_buffs[agent_i][start:end] = next_obs[src_start:src_end]
+                self.done_buffs[agent_i][start:end] = dones[src_start:src_end, agent_i]
+        self.curr_i = (self.curr_i + nentries) % self.max_steps
+        self.filled_i = min(self.filled_i + nentries, self.max_steps)
+
+    def sample(self, N, to_gpu=False, norm_rews=True, replace=False):
+        """
+        Sample N transitions (with replacement if replace). All fields are
+        gathered into one (pinned when to_gpu) output tensor that is reused
+        by the next call, and the returned per-agent tensors are column views
+        of it, so they are only valid until sample is called again
+        """
+        inds = self.sample_indices(N, replace=replace)
+        if self.path is not None:
+            inds.sort()  # read the files front to back
+        return self.get(inds, to_gpu=to_gpu, norm_rews=norm_rews)
+
+    def get(self, inds, to_gpu=False, norm_rews=True):
+        """
+        Gather the transitions at inds, returned as by sample
+        """
+        N = len(inds)
+        rows, shifts = np.divmod(inds, self.n_perms)
+        out = self._get_out(N, to_gpu)
+        out_np = out.numpy()
+        for data, cols, onehot, perms in zip(self.data, self.data_cols,
+                                             self.data_onehot, self.data_perms):
+            if perms is None:
+                rows_data = data[rows]
+            else:
+                rows_data = data[rows[:, None], perms[shifts]]
+            if onehot is None:
+                out_np[:, cols] = rows_data
+            else:
+                block = out_np[:, cols]
+                block[:] = 0
+                block[np.arange(N)[:, None], onehot + rows_data] = 1
         if norm_rews:
-            ret_rews = [cast((self.rew_buffs[i][inds] -
-                              self.rew_buffs[i][:self.filled_i].mean()) /
-                             self.rew_buffs[i][:self.filled_i].std())
-                        for i in range(self.num_agents)]
-        else:
-            ret_rews = [cast(self.rew_buffs[i][inds]) for i in range(self.num_agents)]
-        return ([cast(self.obs_buffs[i][inds]) for i in range(self.num_agents)],
-                [cast(self.ac_buffs[i][inds]) for i in range(self.num_agents)],
-                ret_rews,
-                [cast(self.next_obs_buffs[i][inds]) for i in range(self.num_agents)],
-                [cast(self.done_buffs[i][inds]) for i in range(self.num_agents)])
+            mean, std = self._norm_stats()
+            rews = out_np[:, self._rew_cols()]
+            rews -= mean
+            rews /= std
+        if to_gpu:
+            out = out.cuda(non_blocking=True)
+            self.copy_event = torch.cuda.Event()
+            self.copy_event.record()
+        return tuple([out[:, self.out_cols[(field, i)]]
+                      for i in range(self.num_agents)]
+                     for field in ('obs', 'acs', 'rews', 'next_obs', 'dones'))
+
+    def sample_indices(self, N, replace=False):
+        """
+        Draw N indices of filled entries in O(N), independent of the buffer
+        size (Generator.choice draws without replacement by Floyd's
+        algorithm instead of permuting the whole range)
+        """
+        if replace:
+            return self.rng.integers(len(self), size=N)
+        return self.rng.choice(len(self), size=N, replace=False,
+                               shuffle=False)
+
+    def _get_out(self, N, to_gpu):
+        if (self.out is None or self.out.shape[0] != N or
+                self.out.is_pinned() != to_gpu):
+            self.out = torch.empty((N, self.out_width), pin_memory=to_gpu)
+            self.copy_event = None
+        elif self.copy_event is not None:
+            # don't overwrite the pinned buffer while it is still being copied
+            self.copy_event.synchronize()
+        return self.out
+
+    def _norm_stats(self):
+        mean, std = self.rew_stats.mean, self.rew_stats.std
+        if self.n_perms > 1:
+            # with rotated agents, every agent samples the rewards of all
+            pooled_mean = mean.mean()
+            std = np.sqrt((std ** 2 + (mean - pooled_mean) ** 2).mean())
+            mean = pooled_mean
+        return mean, std
+
+    def _rew_cols(self):
+        # rewards of all agents share a dtype, so their columns are adjacent
+        return slice(self.out_cols[('rews', 0)],
+                     self.out_cols[('rews', self.num_agents - 1)] + 1)
+
+    def get_reward_stats(self):
+        """
+        Mean and standard deviation of the stored rewards of each agent
+        """
+        return self.rew_stats.mean, self.rew_stats.std
 
     def get_average_rewards(self, N):
         if self.filled_i == self.max_steps:
-            inds = np.arange(self.curr_i - N, self.curr_i)  # allow for negative indexing
+            inds = np.arange(self.curr_i - N, self.curr_i)  # negative indices wrap around the ring
         else:
             inds = np.arange(max(0, self.curr_i - N), self.curr_i)
         return [self.rew_buffs[i][inds].mean() for i in range(self.num_agents)]
+
+
+def _write_json(fname, obj):
+    # write to a temporary file first, so fname is never left half written
+    with open(fname + '.tmp', 'w') as f:
+        json.dump(obj, f)
+    os.replace(fname + '.tmp', fname)
+
+
+class PrioritizedReplayBuffer(ReplayBuffer):
+    """
+    Replay buffer sampling transitions in proportion to their (TD error)
+    priorities, with one sum tree per agent since each agent's critic is
+    updated on its own sample
+    """
+    def __init__(self, max_steps, num_agents, obs_dims, ac_dims, alpha=0.6,
+                 eps=1e-6, **kwargs):
+        """
+        Inputs:
+            alpha (float): Priority exponent (0 samples uniformly)
+            eps (float): Added to TD errors so no priority is zero
+            Other inputs as for ReplayBuffer
+        """
+        super(PrioritizedReplayBuffer, self).__init__(
+            max_steps, num_agents, obs_dims, ac_dims, **kwargs)
+        self.alpha = alpha
+        self.eps = eps
+        self.trees = [SumTree(max_steps * self.n_perms)
+                      for _ in range(num_agents)]
+        self.max_priority = 1.0  # given to new transitions
+        if self.filled_i:  # reopened from disk
+            self._reset_priorities()
+
+    def _reset_priorities(self):
+        for tree in self.trees:
+            tree.tree[:] = 0
+            tree.update(np.arange(len(self)), self.max_priority)
+
+    def load(self, path):
+        super(PrioritizedReplayBuffer, self).load(path)
+        self._reset_priorities()
+
+    def nbytes(self):
+        return (super(PrioritizedReplayBuffer, self).nbytes() +
+                sum(tree.tree.nbytes for tree in self.trees))
+
+    def push(self, observations, actions, rewards, next_observations, dones):
+        rows = (self.curr_i + np.arange(observations.shape[0])) % self.max_steps
+        inds = (rows[:, None] * self.n_perms + np.arange(self.n_perms)).ravel()
+        super(PrioritizedReplayBuffer, self).push(
+            observations, actions, rewards, next_observations, dones)
+        for tree in self.trees:
+            tree.update(inds, self.max_priority)
+
+    def sample_prioritized(self, N, agent_i, beta, to_gpu=False,
+                           norm_rews=True):
+        """
+        Sample N transitions by the priorities of agent agent_i (one draw
+        from each of N equal segments of the total priority)
+        Outputs:
+            sample: as returned by sample
+            weights (torch.Tensor): Importance-sampling weights with exponent
+                                    beta, normalized by their maximum
+            inds (np.ndarray): Sampled indices, for update_priorities
+        """
+        tree = self.trees[agent_i]
+        values = (np.arange(N) + self.rng.random(N)) * tree.total / N
+        inds = np.minimum(tree.find(values), len(self) - 1)
+        probs = tree.tree[inds + tree.capacity] / tree.total
+        weights = (len(self) * probs) ** -beta
+        weights = torch.from_numpy((weights / weights.max()).astype(np.float32))
+        if to_gpu:
+            weights = weights.cuda()
+        return self.get(inds, to_gpu=to_gpu, norm_rews=norm_rews), weights, inds
+
+    def update_priorities(self, agent_i, inds, td_errors):
+        """
+        Set the priorities of agent agent_i's transitions inds from the
+        absolute TD errors of its critic
+        """
+        priorities = (np.abs(td_errors) + self.eps) ** self.alpha
+        self.trees[agent_i].update(inds, priorities)
+        self.max_priority = max(self.max_priority, priorities.max())
@@ -2,13 +2,79 @@
 Modified from OpenAI Baselines code to work with multi-agent envs
 """
 import numpy as np
-from multiprocessing import Process, Pipe
+from multiprocessing import Process, Pipe, resource_tracker
+from multiprocessing.shared_memory import SharedMemory
 from baselines.common.vec_env import VecEnv, CloudpickleWrapper
 
 
+class SharedStepBuffers(object):
+    """
+    Observation, reward and done arrays for all envs in one shared memory
+    block, so that workers can write step results in place. Each env has two
+    slots used in turn (leading axis of every array), so the arrays returned
+    by one step stay valid while the next step is written (main.run still
+    holds obs when it gets next_obs)
+    """
+    def __init__(self, nenvs, obs_dims, shm=None):
+        """
+        Inputs:
+            nenvs (int): Number of environments
+            obs_dims (list of ints): Observation dimensions for each agent
+            shm (SharedMemory): Existing block to attach to (None to create)
+        """
+        self.nenvs = nenvs
+        self.obs_dims = obs_dims
+        nagents = len(obs_dims)
+        layout = ([((2, nenvs, odim), np.float64) for odim in obs_dims] +
+                  [((2, nenvs, nagents), np.float64),
+                   ((2, nenvs, nagents), np.bool_)])
+        nbytes = sum(int(np.prod(shape)) * np.dtype(dtype).itemsize
+                     for shape, dtype in layout)
+        if shm is None:
+            shm = SharedMemory(create=True, size=max(1, nbytes))
+        # a worker attaches through unpickling shm, which registers the block
+        # with the worker's resource tracker. SubprocVecEnv starts the
+        # creating process's tracker before forking the workers, so they
+        # share it and the registration is only repeated (a worker starting
+        # its own tracker would unlink the block when it exits). The creating
+        # process unlinks the block in close
+        self.shm = shm
+        arrs = []
+        offset = 0
+        for shape, dtype in layout:
+            arrs.append(np.ndarray(shape, dtype=dtype, buffer=shm.buf,
+                                   offset=offset))
+            offset += arrs[-1].nbytes
+        self.obs = arrs[:nagents]
+        self.rews, self.dones = arrs[nagents:]
+
+    def __reduce__(self):
+        return (SharedStepBuffers, (self.nenvs, self.obs_dims, self.shm))
+
+    def write(self, slot, rank, ob, reward=None, done=None):
+        for agent_obs, agent_ob in zip(self.obs, ob):
+            agent_obs[slot, rank] = agent_ob
+        if reward is not None:
+            self.rews[slot, rank] = reward
+            self.dones[slot, rank] = done
+
+    def close(self, unlink=False):
+        self.obs, self.rews, self.dones = [], None, None
+        try:
+            self.shm.close()
+        except BufferError:  # views handed out are still alive
+            pass
+        if unlink:
+            try:
+                self.shm.unlink()
+            except FileNotFoundError:  # already removed
+                pass
+
+
 def worker(remote, parent_remote, env_fn_wrapper):
     parent_remote.close()
     env = env_fn_wrapper.x()
+    bufs = None
     while True:
         cmd, data = remote.recv()
         if cmd == 'step':
@@ -16,14 +82,29 @@ def worker(remote, parent_remote, env_fn_wrapper):
             if all(done):
                 ob = env.reset()
             remote.send((ob, reward, done, info))
+        elif cmd == 'step_shm':
+            action, slot = data
+            ob, reward, done, info = env.step(action)
+            if all(done):
+                ob = env.reset()
+            bufs.write(slot, rank, ob, reward, done)
+            remote.send(info)
         elif cmd == 'reset':
             ob = env.reset()
             remote.send(ob)
+        elif cmd == 'reset_shm':
+            bufs.write(data, rank, env.reset())
+            remote.send(None)
+        elif cmd == 'attach_shm':
+            bufs, rank = data
+            remote.send(None)
         elif cmd == 'reset_task':
             ob = env.reset_task()
             remote.send(ob)
         elif cmd == 'close':
             remote.close()
+            if bufs is not None:
+                bufs.close()
             break
         elif cmd == 'get_spaces':
             remote.send((env.observation_space, env.action_space))
@@ -38,14 +119,20 @@ def worker(remote, parent_remote, env_fn_wrapper):
 
 
 class SubprocVecEnv(VecEnv):
-    def __init__(self, env_fns, spaces=None):
+    def __init__(self, env_fns, spaces=None, shared_memory=False):
         """
         envs: list of gym environments to run in subprocesses
+        shared_memory: if True, workers write observations, rewards and dones
+            into shared memory and only a short message goes over the pipe
         """
-        self.waiting = False
+        self.pending = set()  # envs with a step in flight
         self.closed = False
         nenvs = len(env_fns)
         self.remotes, self.work_remotes = zip(*[Pipe() for _ in range(nenvs)])
+        if shared_memory:
+            # forked workers then share this process's tracker (see
+            # SharedStepBuffers)
+            resource_tracker.ensure_running()
         self.ps = [Process(target=worker, args=(work_remote, remote, CloudpickleWrapper(env_fn)))
             for (work_remote, remote, env_fn) in zip(self.work_remotes, self.remotes, env_fns)]
         for p in self.ps:
@@ -60,22 +147,76 @@ class SubprocVecEnv(VecEnv):
         self.agent_types = self.remotes[0].recv()
         VecEnv.__init__(self, len(env_fns), observation_space, action_space)
 
-    def step_async(self, actions):
-        for remote, action in zip(self.remotes, actions):
-            remote.send(('step', action))
-        self.waiting = True
+        self.bufs = None
+        if shared_memory:
+            self.bufs = SharedStepBuffers(nenvs, [obsp.shape[0] for obsp in
+                                                  observation_space])
+            self.slots = np.zeros(nenvs, dtype=int)
+            for rank, remote in enumerate(self.remotes):
+                remote.send(('attach_shm', (self.bufs, rank)))
+            for remote in self.remotes:
+                remote.recv()
 
-    def step_wait(self):
-        results = [remote.recv() for remote in self.remotes]
-        self.waiting = False
+    def step_async(self, actions, env_ids=None):
+        """
+        actions: one entry per env in env_ids
+        env_ids: subset of envs to step (all if None); the others may keep
+            stepping in the background
+        """
+        env_ids = self._env_ids(env_ids)
+        if self.bufs is not None:
+            self.slots[env_ids] ^= 1
+            for k, action in zip(env_ids, actions):
+                self.remotes[k].send(('step_shm', (action, self.slots[k])))
+        else:
+            for k, action in zip(env_ids, actions):
+                self.remotes[k].send(('step', action))
+        self.pending.update(env_ids)
+
+    def step_wait(self, env_ids=None):
+        env_ids = self._env_ids(env_ids)
+        results = [self.remotes[k].recv() for k in env_ids]
+        self.pending.difference_update(env_ids)
+        if self.bufs is not None:
+            obs, rews, dones = self._shared_results(env_ids)
+            return obs, rews, dones, tuple(results)
         obs, rews, dones, infos = zip(*results)
         return np.stack(obs), np.stack(rews), np.stack(dones), infos
 
     def reset(self):
+        if self.bufs is not None:
+            self.slots ^= 1
+            for k, remote in enumerate(self.remotes):
+                remote.send(('reset_shm', self.slots[k]))
+            for remote in self.remotes:
+                remote.recv()
+            return self._shared_results(np.arange(self.num_envs))[0]
         for remote in self.remotes:
             remote.send(('reset', None))
         return np.stack([remote.recv() for remote in self.remotes])
 
+    def _env_ids(self, env_ids):
+        if env_ids is None:
+            return np.arange(self.num_envs)
+        return np.asarray(env_ids)
+
+    # observations ((n, nagents) object array of per-agent rows), rewards and
+    # dones of envs env_ids from the shared arrays; these are views when all
+    # envs are read from the same slot. The stacked (n, obs_dim) array of
+    # each agent is kept in obs_n
+    def _shared_results(self, env_ids):
+        slots = self.slots[env_ids]
+        if len(env_ids) == self.num_envs and (slots == slots[0]).all():
+            sel = slots[0]
+        else:
+            sel = (slots, env_ids)
+        self.obs_n = [agent_obs[sel] for agent_obs in self.bufs.obs]
+        obs = np.empty((len(env_ids), len(self.obs_n)), dtype=object)
+        for i, agent_obs in enumerate(self.obs_n):
+            for k in range(len(env_ids)):
+                obs[k, i] = agent_obs[k]
+        return obs, self.bufs.rews[sel], self.bufs.dones[sel]
+
     def reset_task(self):
         for remote in self.remotes:
             remote.send(('reset_task', None))
@@ -84,13 +225,14 @@ class SubprocVecEnv(VecEnv):
     def close(self):
         if self.closed:
             return
-        if self.waiting:
-            for remote in self.remotes:            
-                remote.recv()
+        for k in self.pending:
+            self.remotes[k].recv()
         for remote in self.remotes:
             remote.send(('close', None))
         for p in self.ps:
             p.join()
+        if self.bufs is not None:
+            self.bufs.close(unlink=True)
         self.closed = True
 
 
@@ -37,12 +37,34 @@ def make_env(scenario_name, benchmark=False, discrete_action=False):
     # create world
     world = scenario.make_world()
     # create multiagent environment
+    # whole-world callbacks, if the scenario implements them
+    vectorized = dict(rewards_callback=getattr(scenario, 'rewards', None),
+                      observations_callback=getattr(scenario, 'observations', None))
     if benchmark:        
         env = MultiAgentEnv(world, scenario.reset_world, scenario.reward,
                             scenario.observation, scenario.benchmark_data,
+                            **vectorized
         )#discrete_action=discrete_action)
     else:
         env = MultiAgentEnv(world, scenario.reset_world, scenario.reward,
                             scenario.observation,
+                            **vectorized
         )#discrete_action=discrete_action)
     return env
+
+def make_batched_env(scenario_name, n_envs, discrete_action=False):
+    '''
+    Creates a BatchedMultiAgentEnv that steps n_envs copies of the scenario
+    in one process. Only scenarios that implement the whole-world
+    rewards(world) / observations(world) callbacks are supported. All copies
+    share the entity properties (sizes, speeds, ...) set by make_world.
+    '''
+    from multiagent.environment import MultiAgentEnv, BatchedMultiAgentEnv
+    import multiagent.scenarios as scenarios
+
+    scenario = scenarios.load(scenario_name + ".py").Scenario()
+    world = scenario.make_world()
+    env = MultiAgentEnv(world, scenario.reset_world, scenario.reward,
+                        scenario.observation)
+    return BatchedMultiAgentEnv(env, n_envs, scenario.rewards,
+                                scenario.observations)
@@ -2,32 +2,47 @@ import os
 import torch
 import torch.nn.functional as F
 import torch.distributed as dist
-from torch.autograd import Variable
-import numpy as np
+import torch.multiprocessing as mp
+
+def _param_data(nets):
+    if isinstance(nets, torch.nn.Module):
+        nets = [nets]
+    return [param.data for net in nets for param in net.parameters()]
 
 # https://github.com/ikostrikov/pytorch-ddpg-naf/blob/master/ddpg.py#L11
 def soft_update(target, source, tau):
     """
     Perform DDPG soft update (move target params toward source based on weight
-    factor tau)
+    factor tau), as one fused in-place op over all parameters
     Inputs:
-        target (torch.nn.Module): Net to copy parameters to
-        source (torch.nn.Module): Net whose parameters to copy
+        target (torch.nn.Module or list): Net(s) to copy parameters to
+        source (torch.nn.Module or list): Net(s) whose parameters to copy
         tau (float, 0 < x < 1): Weight factor for update
     """
-    for target_param, param in zip(target.parameters(), source.parameters()):
-        target_param.data.copy_(target_param.data * (1.0 - tau) + param.data * tau)
+    target_params = _param_data(target)
+    source_params = _param_data(source)
+    if hasattr(torch, '_foreach_lerp_'):
+        torch._foreach_lerp_(target_params, source_params, tau)
+    else:
+        for target_param, param in zip(target_params, source_params):
+            target_param.lerp_(param, tau)
 
 # https://github.com/ikostrikov/pytorch-ddpg-naf/blob/master/ddpg.py#L15
 def hard_update(target, source):
     """
     Copy network parameters from source to target
     Inputs:
-        target (torch.nn.Module): Net to copy parameters to
-        source (torch.nn.Module): Net whose parameters to copy
+        target (torch.nn.Module or list): Net(s) to copy parameters to
+        source (torch.nn.Module or list): Net(s) whose parameters to copy
     """
-    for target_param, param in zip(target.parameters(), source.parameters()):
-        target_param.data.copy_(param.data)
+    _foreach_copy(_param_data(target), _param_data(source))
+
+def _foreach_copy(targets, sources):
+    if hasattr(torch, '_foreach_copy_'):
+        torch._foreach_copy_(targets, sources)
+    else:
+        for target, source in zip(targets, sources):
+            target.copy_(source)
 
 # https://github.com/seba-1511/dist_tuto.pth/blob/gh-pages/train_dist.py
 def average_gradients(model):
@@ -37,6 +52,23 @@ def average_gradients(model):
         dist.all_reduce(param.grad.data, op=dist.reduce_op.SUM, group=0)
         param.grad.data /= size
 
+def clip_grad_norm_stacked(parameters, max_norm, n_nets):
+    """
+    Clip the gradient norm of each net of stacked parameters separately (as
+    torch.nn.utils.clip_grad_norm_ would for each unstacked net)
+    Inputs:
+        parameters (iterable of torch.Tensor): Parameters whose leading
+                                               n_nets blocks belong to
+                                               successive nets
+        max_norm (float): Maximum gradient norm of each net
+        n_nets (int): Number of stacked nets
+    """
+    grads = [p.grad.view(n_nets, -1) for p in parameters if p.grad is not None]
+    norms = torch.sqrt(sum(grad.pow(2).sum(1) for grad in grads))
+    scale = torch.clamp(max_norm / (norms + 1e-6), max=1.0)
+    for grad in grads:
+        grad.mul_(scale[:, None])
+
 # https://github.com/seba-1511/dist_tuto.pth/blob/gh-pages/train_dist.py
 def init_processes(rank, size, fn, backend='gloo'):
     """ Initialize the distributed environment. """
@@ -45,47 +77,100 @@ def init_processes(rank, size, fn, backend='gloo'):
     dist.init_process_group(backend, rank=rank, world_size=size)
     fn(rank, size)
 
-def onehot_from_logits(logits, eps=0.0):
+class SharedPolicies(object):
+    """
+    CPU copy of the parameters and buffers of policy networks in shared
+    memory, published by a learner process and fetched by actor processes
+    (pass to them as a process argument)
+    """
+    def __init__(self, policies, ctx=mp):
+        """
+        Inputs:
+            policies (list of torch.nn.Module): Policies to share
+            ctx: Multiprocessing context of the lock and version counter
+        """
+        self.tensors = [tensor.detach().cpu().clone().share_memory_()
+                        for tensor in _state_tensors(policies)]
+        self.lock = ctx.Lock()
+        self.version = ctx.Value('i', 0, lock=False)  # guarded by self.lock
+
+    def publish(self, policies):
+        with self.lock:
+            _foreach_copy(self.tensors, _state_tensors(policies))
+            self.version.value += 1
+
+    def fetch(self, policies, version=-1):
+        """
+        Copy the published tensors into policies if they are newer than
+        version
+        Outputs:
+            version (int): Version of the tensors now in policies
+        """
+        if self.version.value == version:
+            return version
+        with self.lock:
+            _foreach_copy(_state_tensors(policies), self.tensors)
+            return self.version.value
+
+def _state_tensors(nets):
+    return [tensor for net in nets for tensor in net.state_dict().values()]
+
+def onehot_from_logits(logits, eps=0.0, generator=None):
     """
     Given batch of logits, return one-hot sample using epsilon greedy strategy
-    (based on given epsilon)
+    (based on given epsilon). Random draws use generator if given
     """
     # get best (according to current policy) actions in one-hot form
     argmax_acs = (logits == logits.max(1, keepdim=True)[0]).float()
     if eps == 0.0:
         return argmax_acs
     # get random actions in one-hot form
-    rand_acs = Variable(torch.eye(logits.shape[1])[[np.random.choice(
-        range(logits.shape[1]), size=logits.shape[0])]], requires_grad=False)
+    rand_acs = F.one_hot(torch.randint(logits.shape[1], (logits.shape[0],),
+                                       generator=generator,
+                                       device=logits.device),
+                         logits.shape[1]).float()
     # chooses between best and random actions using epsilon greedy
-    return torch.stack([argmax_acs[i] if r > eps else rand_acs[i] for i, r in
-                        enumerate(torch.rand(logits.shape[0]))])
+    explore = torch.rand(logits.shape[0], 1, generator=generator,
+                         device=logits.device) <= eps
+    return torch.where(explore, rand_acs, argmax_acs)
 
 # modified for PyTorch from https://github.com/ericjang/gumbel-softmax/blob/master/Categorical%20VAE.ipynb
-def sample_gumbel(shape, eps=1e-20, tens_type=torch.FloatTensor):
-    """Sample from Gumbel(0, 1)"""
-    U = Variable(tens_type(*shape).uniform_(), requires_grad=False)
-    return -torch.log(-torch.log(U + eps) + eps)
+def sample_gumbel(shape, eps=1e-20, tens_type=torch.FloatTensor,
+                  generator=None, out=None):
+    """Sample from Gumbel(0, 1), in place into out if given"""
+    if out is None:
+        out = tens_type(*shape)
+    out.uniform_(generator=generator)
+    # -log(-log(U + eps) + eps)
+    return out.add_(eps).log_().neg_().add_(eps).log_().neg_()
 
 # modified for PyTorch from https://github.com/ericjang/gumbel-softmax/blob/master/Categorical%20VAE.ipynb
-def gumbel_softmax_sample(logits, temperature):
-    """ Draw a sample from the Gumbel-Softmax distribution"""
-    y = logits + sample_gumbel(logits.shape, tens_type=type(logits.data)).to(logits.device)
+def gumbel_softmax_sample(logits, temperature, generator=None, out=None):
+    """ Draw a sample from the Gumbel-Softmax distribution (noise drawn into
+    out if given, a buffer shaped like logits owned by the caller)"""
+    if out is None:
+        out = torch.empty_like(logits)
+    y = logits + sample_gumbel(logits.shape, generator=generator, out=out)
     return F.softmax(y / temperature, dim=-1)
 
 # modified for PyTorch from https://github.com/ericjang/gumbel-softmax/blob/master/Categorical%20VAE.ipynb
-def gumbel_softmax(logits, temperature=1.0, hard=False, device='cuda'):
+def gumbel_softmax(logits, temperature=1.0, hard=False, device='cuda',
+                   generator=None, out=None):
     """Sample from the Gumbel-Softmax distribution and optionally discretize.
     Args:
       logits: [batch_size, n_class] unnormalized log-probs
       temperature: non-negative scalar
       hard: if True, take argmax, but differentiate w.r.t. soft sample y
+      generator: torch.Generator to draw the noise from (global RNG if None)
+      out: buffer shaped like logits to draw the noise into (a new one if
+        None)
     Returns:
       [batch_size, n_class] sample from the Gumbel-Softmax distribution.
       If hard=True, then the returned sample will be one-hot, otherwise it will
       be a probabilitiy distribution that sums to 1 across classes
     """
-    y = gumbel_softmax_sample(logits, temperature)
+    y = gumbel_softmax_sample(logits, temperature, generator=generator,
+                              out=out)
     if hard:
         y_hard = onehot_from_logits(y)
         y = (y_hard - y).detach() + y
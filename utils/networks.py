@@ -1,3 +1,6 @@
+import copy
+import math
+import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
@@ -21,7 +24,7 @@ class MLPNetwork(nn.Module):
             self.in_fn.weight.data.fill_(1)
             self.in_fn.bias.data.fill_(0)
         else:
-            self.in_fn = lambda x: x
+            self.in_fn = nn.Identity()
         self.fc1 = nn.Linear(input_dim, hidden_dim)
         self.fc2 = nn.Linear(hidden_dim, hidden_dim)
         self.fc3 = nn.Linear(hidden_dim, out_dim)
@@ -29,9 +32,9 @@ class MLPNetwork(nn.Module):
         if constrain_out and not discrete_action:
             # initialize small to prevent saturation
             self.fc3.weight.data.uniform_(-3e-3, 3e-3)
-            self.out_fn = F.tanh
+            self.out_fn = nn.Tanh()
         else:  # logits for discrete action (will softmax later)
-            self.out_fn = lambda x: x
+            self.out_fn = nn.Identity()
 
     def forward(self, X):
         """
@@ -43,4 +46,156 @@ class MLPNetwork(nn.Module):
         h1 = self.nonlin(self.fc1(self.in_fn(X)))
         h2 = self.nonlin(self.fc2(h1))
         out = self.out_fn(self.fc3(h2))
-        return out
\ No newline at end of file
+        return out
+
+    def freeze(self):
+        """
+        Copy of this network for inference only, with the eval-mode input
+        BatchNorm folded into fc1 (same outputs, one module less per call)
+        Outputs:
+            frozen (MLPNetwork): Network without input normalization and
+                                 with gradients disabled
+        """
+        frozen = copy.deepcopy(self)
+        if isinstance(self.in_fn, nn.BatchNorm1d):
+            scale, shift = _batchnorm_affine(self.in_fn)
+            with torch.no_grad():
+                # fc1(x * scale + shift) = (W * scale) x + (W shift + b)
+                frozen.fc1.bias.add_(frozen.fc1.weight @ shift)
+                frozen.fc1.weight.mul_(scale)
+            frozen.in_fn = nn.Identity()
+        return frozen.eval().requires_grad_(False)
+
+class StackedMLPNetwork(nn.Module):
+    """
+    MLP networks of several agents with their parameters stacked along a
+    leading agent dimension, evaluated for all agents at once with batched
+    matrix multiplies. Inputs and outputs of agents with smaller dimensions
+    are zero-padded to the largest one
+    """
+    def __init__(self, input_dims, out_dims, hidden_dim=64, nonlin=F.relu,
+                 constrain_out=False, norm_in=True, discrete_action=True):
+        """
+        Inputs:
+            input_dims (list of ints): Number of input dimensions of each net
+            out_dims (list of ints): Number of output dimensions of each net
+            hidden_dim (int): Number of hidden dimensions
+            nonlin (PyTorch function): Nonlinearity to apply to hidden layers
+        """
+        super(StackedMLPNetwork, self).__init__()
+        self.n_nets = len(input_dims)
+        self.input_dims = input_dims
+        self.out_dims = out_dims
+        self.input_dim = max(input_dims)
+        self.out_dim = max(out_dims)
+
+        if norm_in:  # normalize inputs (each net's features separately)
+            self.in_fn = nn.BatchNorm1d(self.n_nets * self.input_dim)
+            self.in_fn.weight.data.fill_(1)
+            self.in_fn.bias.data.fill_(0)
+        else:
+            self.in_fn = None
+        hidden_dims = [hidden_dim] * self.n_nets
+        layer_dims = [(input_dims, hidden_dims), (hidden_dims, hidden_dims),
+                      (hidden_dims, out_dims)]
+        self.weights = nn.ParameterList()
+        self.biases = nn.ParameterList()
+        for fan_ins, fan_outs in layer_dims:
+            weight = torch.zeros(self.n_nets, max(fan_ins), max(fan_outs))
+            bias = torch.zeros(self.n_nets, 1, max(fan_outs))
+            for i, (fan_in, fan_out) in enumerate(zip(fan_ins, fan_outs)):
+                # same initialization as nn.Linear, leaving padding at zero
+                bound = 1 / math.sqrt(fan_in)
+                weight[i, :fan_in, :fan_out].uniform_(-bound, bound)
+                bias[i, :, :fan_out].uniform_(-bound, bound)
+            self.weights.append(nn.Parameter(weight))
+            self.biases.append(nn.Parameter(bias))
+        self.nonlin = nonlin
+        if constrain_out and not discrete_action:
+            # initialize small to prevent saturation
+            for i, out_dim in enumerate(out_dims):
+                self.weights[2].data[i, :, :out_dim].uniform_(-3e-3, 3e-3)
+            self.out_fn = F.tanh
+        else:  # logits for discrete action (will softmax later)
+            self.out_fn = None
+
+    def forward(self, X, nets=None):
+        """
+        Inputs:
+            X (PyTorch Tensor): Padded inputs of all nets, (n_nets, batch,
+                                input_dim)
+            nets (list of ints): Net to evaluate on each input (all nets in
+                                 order if None)
+        Outputs:
+            out (PyTorch Tensor): Padded outputs, (len(X), batch, out_dim)
+        """
+        if nets is not None:
+            nets = torch.as_tensor(nets, device=X.device)
+            if torch.equal(nets, torch.arange(self.n_nets, device=X.device)):
+                nets = None  # all nets in order, no need to gather them
+        if self.in_fn is not None:
+            X = self._normalize(X, nets)
+        weights, biases = self.weights, self.biases
+        if nets is not None:
+            weights = [w.index_select(0, nets) for w in weights]
+            biases = [b.index_select(0, nets) for b in biases]
+        h1 = self.nonlin(torch.baddbmm(biases[0], X, weights[0]))
+        h2 = self.nonlin(torch.baddbmm(biases[1], h1, weights[1]))
+        out = torch.baddbmm(biases[2], h2, weights[2])
+        if self.out_fn is not None:
+            out = self.out_fn(out)
+        return out
+
+    def _normalize(self, X, nets):
+        n, batch = X.shape[:2]
+        if nets is None:
+            return self.in_fn(X.transpose(0, 1).reshape(batch, -1)).view(
+                batch, n, -1).transpose(0, 1)
+        view = lambda x: x.view(self.n_nets, 1, -1).index_select(0, nets)
+        if self.in_fn.training:
+            # batch statistics of each input, as BatchNorm1d would use (the
+            # running statistics are only updated when all nets are evaluated)
+            mean = X.mean(dim=1, keepdim=True)
+            var = X.var(dim=1, unbiased=False, keepdim=True)
+        else:
+            mean = view(self.in_fn.running_mean)
+            var = view(self.in_fn.running_var)
+        return ((X - mean) / torch.sqrt(var + self.in_fn.eps) *
+                view(self.in_fn.weight) + view(self.in_fn.bias))
+
+    def freeze(self):
+        """
+        Copy of these networks for inference only, with the eval-mode input
+        BatchNorm folded into the first layer (see MLPNetwork.freeze)
+        """
+        frozen = copy.deepcopy(self)
+        if self.in_fn is not None:
+            scale, shift = [x.view(self.n_nets, -1) for x in
+                            _batchnorm_affine(self.in_fn)]
+            with torch.no_grad():
+                frozen.biases[0].add_(shift.unsqueeze(1) @ frozen.weights[0])
+                frozen.weights[0].mul_(scale.unsqueeze(2))
+            frozen.in_fn = None
+        return frozen.eval().requires_grad_(False)
+
+    def stack_inputs(self, xs):
+        """
+        Pad the list of per-net inputs xs to input_dim and stack them
+        """
+        return torch.stack([F.pad(x, (0, self.input_dim - x.shape[1]))
+                            for x in xs])
+
+    def unstack_outputs(self, out):
+        """
+        Split padded outputs into a list of unpadded outputs of each net
+        """
+        return [out[i, :, :out_dim] for i, out_dim in enumerate(self.out_dims)]
+
+
+def _batchnorm_affine(bn):
+    """
+    Scale and shift of BatchNorm module bn in eval mode
+    (bn(x) = x * scale + shift)
+    """
+    scale = bn.weight.detach() / torch.sqrt(bn.running_var + bn.eps)
+    return scale, bn.bias.detach() - bn.running_mean * scale
@@ -15,8 +15,10 @@ class OUNoise:
     def reset(self):
         self.state = np.ones(self.action_dimension) * self.mu
 
-    def noise(self):
-        x = self.state
-        dx = self.theta * (self.mu - x) + self.sigma * np.random.randn(len(x))
-        self.state = x + dx
+    def noise(self, advance=True):
+        # advance=False returns the last sample again
+        if advance:
+            x = self.state
+            dx = self.theta * (self.mu - x) + self.sigma * np.random.randn(len(x))
+            self.state = x + dx
         return self.state * self.scale